@@ -13,17 +13,30 @@
 import collections
 import contextlib
 import errno
+import fcntl
+import functools
+import gc
+import heapq
+import itertools
 import logging
+import math
+import numbers
 import os
 import random
+import select
 import signal
 import socket
+import stat
+import struct
 import sys
 import threading
 import time
+import uuid
 
 import setproctitle
 
+from cotyledon import _stats
+
 LOG = logging.getLogger(__name__)
 
 SIGNAL_TO_NAME = dict((getattr(signal, name), name) for name in dir(signal)
@@ -31,12 +44,393 @@ SIGNAL_TO_NAME = dict((getattr(signal, name), name) for name in dir(signal)
                                                                  'SIG_IGN'))
 
 
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# Message sent by children to the master through the status pipe: pid, kind
+# of message and an optional value. It's smaller than PIPE_BUF, so writes of
+# all children can't be interleaved.
+_STATUS_MSG = struct.Struct("!iBd")
+_STATUS_STARTED = 1
+_STATUS_READY = 2
+_STATUS_LOAD = 3
+# Sent by a worker forked by a zygote, with the pid of the zygote in place of
+# its own pid and its own pid as value
+_STATUS_FORKED = 4
+# Sent by a spare worker once promoted, with its new worker_id as value
+_STATUS_PROMOTED = 5
+# Sent by a TaskService worker with the number of tasks processed as value
+_STATUS_TASK_DONE = 6
+
+# worker_id sent to the zygotes and the spares
+_WORKER_ID = struct.Struct("!i")
+# Provisional worker_id of the spare workers
+_SPARE_WORKER_ID = -1
+# Maximum time to wait for a spare worker to take a worker_id
+_SPARE_PROMOTION_TIMEOUT = 5
+
+# Respawn backoff of a worker slot: the first restart is immediate, then
+# each worker that crashes before _RESPAWN_STABLE_UPTIME doubles the delay,
+# from _RESPAWN_BACKOFF_MIN up to _RESPAWN_BACKOFF_MAX. Workers exiting with
+# status 0 (ie: on SIGTERM or SIGHUP) are always respawned immediately.
+_RESPAWN_BACKOFF_MIN = 1
+_RESPAWN_BACKOFF_MAX = 60
+_RESPAWN_STABLE_UPTIME = 60
+# Number of consecutive early deaths before a service is marked as degraded
+_RESPAWN_CRASH_LOOP = 5
+
+# Interval of the checks of the recycling limits of the workers, and jitter
+# applied to the limits of each worker so they aren't recycled all together
+_RECYCLE_INTERVAL = 5
+_RECYCLE_JITTER = 0.1
+
+# Maximum time to wait for a worker to be ready again during a rolling reload
+_ROLLING_RELOAD_TIMEOUT = 60
+
+
 class _ServiceConfig(object):
-    def __init__(self, service, workers, args, kwargs):
+    def __init__(self, service_id, service, workers, args, kwargs,
+                 reload_batch=None, autoscale=None, zygote=False,
+                 preload=None, spares=0, sockets=None, reuseport=False,
+                 backlog=None, tasks=None, heartbeat_timeout=None,
+                 max_rss=None, max_age=None, max_tasks=None,
+                 cpu_sets=None, shutdown_timeout=None, shutdown_group=0,
+                 max_workers=None):
+        self.service_id = service_id
         self.service = service
         self.workers = workers
         self.args = args
         self.kwargs = kwargs
+        self.reload_batch = reload_batch
+        self.autoscale = autoscale
+        self.autoscaled_at = None
+        self.zygote = zygote
+        self.preload = preload
+        # pid and command pipe of the running zygote and worker_ids of the
+        # fork requests not yet acknowledged
+        self.zygote_pid = None
+        self.zygote_fd = None
+        self.zygote_started_at = None
+        self.zygote_requests = collections.deque()
+        self.spares = spares
+        # Pipe read by the parked spares to get their worker_id, pids of the
+        # spares, the ones ready to be promoted and the worker_id -> timeout
+        # timer of the running promotions
+        self.spare_read_fd = self.spare_write_fd = None
+        self.spare_pids = set()
+        self.spares_ready = set()
+        self.promotions = {}
+        self.degraded = False
+        # Number of running workers that are ready
+        self.ready_workers = 0
+        # Number of deaths of the workers by exit code or signal name
+        self.exits = collections.Counter()
+        # worker_ids waiting to be reloaded and worker_id -> timeout timer of
+        # the ones currently reloading
+        self.reload_queue = collections.deque()
+        self.reloading = {}
+        # Sockets bound by the master: listening ones shared by the workers,
+        # or only reserving the addresses when each worker binds its own
+        # socket with SO_REUSEPORT
+        self.sockets = sockets or []
+        self.reuseport = reuseport
+        self.backlog = backlog
+        self.tasks = tasks
+        # Index of the first slot of the service in the stats board and
+        # number of slots
+        self.stats_first = None
+        self.stats_slots = 0
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_rss = max_rss
+        self.max_age = max_age
+        self.max_tasks = max_tasks
+        # CPUs of the workers, by worker_id modulo the number of sets
+        self.cpu_sets = cpu_sets
+        self.shutdown_timeout = shutdown_timeout
+        self.shutdown_group = shutdown_group
+        self.max_workers = max_workers
+
+
+class _WorkerSlot(object):
+    """State of a worker_id of a service that outlives its processes"""
+
+    def __init__(self):
+        self.pid = None
+        self.started_at = None
+        self.initialized_at = None
+        self.ready_at = None
+        self.failures = 0
+        self.restarts = 0
+        self.respawn_timer = None
+        self.stopping = False
+        # Waiting for the zygote to fork the worker
+        self.spawning = False
+        # Last load reported by the worker and last (time, cpu time) sample
+        self.load = None
+        self.cpu_sample = None
+        # Factor applied to the recycling limits of the current process
+        self.recycle_factor = 1.0
+
+    def next_respawn_delay(self, now, status):
+        """Record a death of the worker and return the respawn delay"""
+        if now - self.started_at >= _RESPAWN_STABLE_UPTIME:
+            self.failures = 0
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            return 0
+        self.failures += 1
+        if self.failures == 1:
+            return 0
+        delay = min(_RESPAWN_BACKOFF_MAX,
+                    _RESPAWN_BACKOFF_MIN * 2 ** (self.failures - 2))
+        # Jitter the delay to not respawn all crashing workers at once
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _pidfd_open(pid):
+    """Return a pidfd for pid or None if pidfds are unavailable"""
+    pidfd_open = getattr(os, 'pidfd_open', None)
+    if pidfd_open is None:
+        return None
+    try:
+        return pidfd_open(pid)
+    except OSError as exc:
+        if exc.errno in (errno.ENOSYS, errno.EPERM, errno.EMFILE,
+                         errno.ENFILE):
+            return None
+        raise
+
+
+# Write end of the master status pipe, only set in children processes
+_status_fd = None
+
+# Read end of the pipe of the tasks to process, only set in children of
+# services added with a TaskQueue
+_task_fd = None
+
+# Shared memory of the stats, index of the first slot of the service of the
+# worker and number of slots of the service, only set in children processes
+_stats_slots = None
+
+
+def _get_worker_stats(worker_id):
+    if _stats_slots is not None:
+        buffer, first, count = _stats_slots
+        if 0 <= worker_id < count:
+            return _stats.Stats(buffer, first + worker_id)
+    # NOTE: Spares, workers above the capacity of the stats board and
+    # services not run by a ServiceManager get private stats
+    return _stats.Stats(bytearray(_stats._slot_offset(1)), 0)
+
+
+# Maximum time between two heartbeats of the worker, only set in children
+# of services with a heartbeat timeout
+_heartbeat_timeout = None
+
+# Listening sockets of the service of the worker, only set in children
+# processes
+_listen_sockets = []
+
+
+def _bind_socket(address, reuseport=False):
+    """Create a socket bound to address
+
+    :param address: a (host, port) tuple or the path of a unix socket
+    :param reuseport: set SO_REUSEPORT on the socket
+    """
+    if isinstance(address, tuple):
+        host, port = address
+        family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+            host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0,
+            socket.AI_PASSIVE)[0]
+    elif reuseport:
+        raise ValueError("SO_REUSEPORT is not supported by unix sockets")
+    else:
+        family, socktype, proto, sockaddr = (socket.AF_UNIX,
+                                             socket.SOCK_STREAM, 0, address)
+        _unlink_stale_unix_socket(address)
+    sock = socket.socket(family, socktype, proto)
+    try:
+        if family != socket.AF_UNIX:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(sockaddr)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def _unlink_stale_unix_socket(path):
+    """Remove a unix socket left by a process that has not exited cleanly
+
+    :return: False if a process still listens on path
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return True
+    except OSError as exc:
+        if exc.errno == errno.ENOENT:
+            return True
+        raise
+    with contextlib.closing(socket.socket(socket.AF_UNIX,
+                                          socket.SOCK_STREAM)) as probe:
+        try:
+            probe.connect(path)
+        except socket.error as exc:
+            if exc.errno != errno.ECONNREFUSED:
+                raise
+            os.unlink(path)
+            return True
+    return False
+
+
+def _notify_master(kind, value=0):
+    if _status_fd is None:
+        return
+    try:
+        os.write(_status_fd, _STATUS_MSG.pack(os.getpid(), kind, value))
+    except EnvironmentError:
+        LOG.debug("Fail to notify master process", exc_info=True)
+
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def _get_cpu_time(pid):
+    """Return the user + system CPU time of a process in seconds"""
+    with open("/proc/%d/stat" % pid) as f:
+        # NOTE: the process name can contain spaces and parenthesis
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS)
+
+
+def _get_memory_usage(pid):
+    """Return the rss, shared and private memory of a process in bytes"""
+    usage = dict(rss=0, shared=0, private=0)
+    with open("/proc/%d/smaps_rollup" % pid) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 3 or fields[2] != 'kB':
+                continue
+            key, value = fields[0].rstrip(':'), int(fields[1]) * 1024
+            if key == 'Rss':
+                usage['rss'] = value
+            elif key.startswith('Shared_'):
+                usage['shared'] += value
+            elif key.startswith('Private_'):
+                usage['private'] += value
+    return usage
+
+
+def _get_rss(pid):
+    """Return the resident memory of a process in bytes"""
+    with open("/proc/%d/statm" % pid) as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_NUMA_NODES_PATH = "/sys/devices/system/node"
+
+
+def _parse_cpu_list(cpulist):
+    """Parse a list of CPUs like 0-3,8,10-11"""
+    cpus = set()
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _get_numa_nodes():
+    """Return the sets of CPUs of each NUMA node"""
+    nodes = []
+    try:
+        names = os.listdir(_NUMA_NODES_PATH)
+    except EnvironmentError:
+        return nodes
+    for name in sorted(names):
+        if not name.startswith('node') or not name[4:].isdigit():
+            continue
+        with open(os.path.join(_NUMA_NODES_PATH, name, 'cpulist')) as f:
+            nodes.append((int(name[4:]), _parse_cpu_list(f.read())))
+    return [cpus for node, cpus in sorted(nodes)]
+
+
+def _get_cpu_sets(cpu_affinity):
+    """Return the list of CPU sets assigned round-robin to the workers"""
+    if not hasattr(os, 'sched_setaffinity'):
+        raise ValueError("cpu_affinity is not supported on this platform")
+    allowed = os.sched_getaffinity(0)
+    if cpu_affinity == 'round-robin':
+        cpu_sets = [set([cpu]) for cpu in sorted(allowed)]
+    elif cpu_affinity == 'numa':
+        cpu_sets = [cpus & allowed for cpus in _get_numa_nodes()]
+        cpu_sets = [cpus for cpus in cpu_sets if cpus]
+        if not cpu_sets:
+            LOG.warning('No NUMA node found, workers are not pinned')
+            cpu_sets = [allowed]
+    elif isinstance(cpu_affinity, (list, tuple)):
+        cpu_sets = []
+        for cpus in cpu_affinity:
+            if isinstance(cpus, numbers.Integral):
+                cpus = [cpus]
+            elif not isinstance(cpus, (list, tuple, set, frozenset)):
+                raise ValueError("invalid CPUs in cpu_affinity: %r" % cpus)
+            for cpu in cpus:
+                if (isinstance(cpu, bool) or
+                        not isinstance(cpu, numbers.Integral) or
+                        cpu not in allowed):
+                    raise ValueError("cpu_affinity contains CPU %r not "
+                                     "available to this process" % cpu)
+            cpu_sets.append(set(cpus))
+    else:
+        raise ValueError("unknown cpu_affinity policy: %s" % cpu_affinity)
+    if not cpu_sets or not all(cpu_sets):
+        raise ValueError("cpu_affinity must contain CPUs")
+    return cpu_sets
+
+
+_PR_SET_PDEATHSIG = 1
+_PR_SET_CHILD_SUBREAPER = 36
+
+# NOTE: Since Python 3.2, signals interrupt lock acquisitions, so
+# Service.run() can block the main thread without delaying signal handlers
+# (https://bugs.python.org/issue5315)
+_RUN_IN_MAIN_THREAD = sys.version_info >= (3, 2)
+
+
+def _prctl(option, arg):
+    """Call prctl(2), return False if it's not available or fails"""
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(option, ctypes.c_ulong(arg), 0, 0, 0) == 0
+    except (ImportError, OSError, AttributeError):
+        return False
+
+
+def _read_exactly(fd, size):
+    """Read size bytes from fd, return None on EOF"""
+    data = b''
+    while len(data) < size:
+        try:
+            chunk = os.read(fd, size - len(data))
+        except OSError as exc:
+            if exc.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
 
 
 def _spawn(target):
@@ -72,6 +466,19 @@ class Service(object):
     """Service name used in the process title and the log messages in additionnal
     of the worker_id."""
 
+    _worker_stats = None
+
+    ready_on_init = True
+    """If True the worker is reported ready to the :py:class:`ServiceManager`
+    as soon as :py:meth:`__init__` returns, otherwise the service has to call
+    :py:meth:`notify_ready` itself."""
+
+    run_in_main_thread = False
+    """If True :py:meth:`run` is executed in the main thread of the worker
+    instead of a dedicated thread, on Python >= 3.2. :py:meth:`terminate` and
+    :py:meth:`reload` then interrupt :py:meth:`run` as signal handlers, so
+    they must not wait for :py:meth:`run` to return."""
+
     def __init__(self, worker_id):
         """Create a new Service
 
@@ -81,8 +488,12 @@ class Service(object):
         super(Service, self).__init__()
         if self.name is None:
             self.name = self.__class__.__name__
-        self.worker_id = worker_id
         self.pid = os.getpid()
+        self._set_worker_id(worker_id)
+
+    def _set_worker_id(self, worker_id):
+        self.worker_id = worker_id
+        self._worker_stats = None
 
         pname = os.path.basename(sys.argv[0])
         self._title = "%(name)s(%(worker_id)d) [%(pid)d]" % dict(
@@ -124,6 +535,71 @@ class Service(object):
         signal.
         """
 
+    def report_load(self, load):
+        """Report the current load of this worker
+
+        It's sent to the :py:class:`ServiceManager` and used by
+        :py:class:`AutoscalePolicy` with metric='load'.
+
+        :param load: the load of the worker
+        :type load: float
+        """
+        _notify_master(_STATUS_LOAD, load)
+
+    def heartbeat(self):
+        """Report to the :py:class:`ServiceManager` that this worker is alive
+
+        Required when the service has been added with a `heartbeat_timeout`,
+        this is cheap enough to be called on each iteration of a main loop.
+        :py:class:`TaskService` and :py:class:`AsyncService` call it
+        automatically.
+        """
+        self.worker_stats._set_heartbeat(_monotonic())
+
+    def task_done(self, count=1):
+        """Report to the :py:class:`ServiceManager` that tasks are processed
+
+        Used to recycle the workers of the services added with `max_tasks`,
+        :py:class:`TaskService` calls it automatically.
+
+        :param count: the number of processed tasks
+        :type count: int
+        """
+        self.worker_stats._add_tasks(count)
+
+    def notify_ready(self):
+        """Report to the :py:class:`ServiceManager` that this worker is ready
+
+        Only required when :py:attr:`ready_on_init` is False, for example when
+        caches are warmed up in :py:meth:`run`.
+        """
+        _notify_master(_STATUS_READY)
+
+    @property
+    def worker_stats(self):
+        """Counters and gauges of this worker
+
+        They are shared with the :py:class:`ServiceManager` without any
+        system call, see :py:meth:`ServiceManager.stats`.
+
+        :rtype: :py:class:`Stats`
+        """
+        if self._worker_stats is None:
+            self._worker_stats = _get_worker_stats(self.worker_id)
+        return self._worker_stats
+
+    @property
+    def listen_sockets(self):
+        """Listening sockets of the service
+
+        The sockets bound for the `listen` addresses passed to
+        :py:meth:`ServiceManager.add`, in the same order. It's available
+        before :py:meth:`__init__` is called.
+
+        :rtype: list of :py:class:`socket.socket`
+        """
+        return list(_listen_sockets)
+
     def _run(self):
         LOG.debug("Run service %s" % self._title)
         with _exit_on_exception():
@@ -132,15 +608,83 @@ class Service(object):
     def _reload(self, sig, frame):
         with _exit_on_exception():
             self.reload()
+        _notify_master(_STATUS_READY)
 
     def _clean_exit(self, *args, **kwargs):
         signal.signal(signal.SIGTERM, signal.SIG_IGN)
         LOG.info('Caught SIGTERM signal, '
                  'graceful exiting of service %s' % self._title)
         with _exit_on_exception():
-            self.terminate()
+            self._terminate()
             sys.exit(0)
 
+    def _terminate(self):
+        self.terminate()
+
+
+class AutoscalePolicy(object):
+    """Adjust the number of workers of a service to its load
+
+    Every `interval` seconds, the average load of the ready workers of the
+    service is computed. When it's above `scale_up` one worker is added,
+    when it's below `scale_down` one worker is removed. After a change,
+    nothing is done during `cooldown` seconds to let the load spread on the
+    new set of workers.
+
+    The load is either the CPU usage of each worker (1.0 means a worker uses
+    a whole CPU), or the value reported by the workers with
+    :py:meth:`Service.report_load`.
+    """
+
+    def __init__(self, min_workers, max_workers, metric='cpu',
+                 scale_up=0.75, scale_down=0.25, interval=10, cooldown=60):
+        """Creates the AutoscalePolicy object
+
+        :param min_workers: minimal number of workers
+        :type min_workers: int
+        :param max_workers: maximal number of workers
+        :type max_workers: int
+        :param metric: 'cpu' or 'load'
+        :type metric: str
+        :param scale_up: average load above which a worker is added
+        :type scale_up: float
+        :param scale_down: average load below which a worker is removed
+        :type scale_down: float
+        :param interval: time in seconds between two load measurements
+        :type interval: float
+        :param cooldown: minimal time in seconds between two scalings
+        :type cooldown: float
+        """
+        if not 0 < min_workers <= max_workers:
+            raise ValueError("min_workers must be greater than 0 and lower "
+                             "or equal to max_workers")
+        if metric not in ('cpu', 'load'):
+            raise ValueError("metric must be 'cpu' or 'load'")
+        if scale_down >= scale_up:
+            raise ValueError("scale_down must be lower than scale_up")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.metric = metric
+        self.scale_up = scale_up
+        self.scale_down = scale_down
+        self.interval = interval
+        self.cooldown = cooldown
+
+    def get_workers(self, workers, load):
+        """Return the number of workers needed for the average load
+
+        :param workers: the current number of workers
+        :type workers: int
+        :param load: the average load of the workers, None if unknown
+        :type load: float
+        """
+        if load is not None:
+            if load > self.scale_up:
+                workers += 1
+            elif load < self.scale_down:
+                workers -= 1
+        return max(self.min_workers, min(self.max_workers, workers))
+
 
 class ServiceManager(object):
     """Manage lifetimes of services
@@ -188,26 +732,98 @@ class ServiceManager(object):
     _marker = object()
     _process_runner_already_created = False
 
-    def __init__(self, wait_interval=0.01):
+    def __init__(self, wait_interval=0.01, start_concurrency=None,
+                 ready_ratio=1.0, stats_path=None, control_socket=None,
+                 metrics_address=None, metrics_textfile=None):
         """Creates the ServiceManager object
 
-        :param wait_interval: time between each new process spawn
+        :param wait_interval: unused, kept for backward compatibility. The
+                              supervision loop now sleeps until a signal
+                              (SIGCHLD, SIGTERM, SIGHUP, ...) wakes it up.
         :type wait_interval: float
-
+        :param start_concurrency: maximum number of workers running their
+                                  :py:meth:`Service.__init__` at the same
+                                  time, unlimited by default
+        :type start_concurrency: int
+        :param ready_ratio: fraction of the workers of each service that must
+                            be ready before notifying systemd that the
+                            application is ready
+        :type ready_ratio: float
+        :param stats_path: file holding the stats of the workers, to read
+                           them from other processes with
+                           :py:func:`read_stats`. By default the stats are
+                           only in memory.
+        :type stats_path: str
+        :param control_socket: path of a unix socket to get the status of
+                               the workers, reload, restart and scale the
+                               services while they run, with the
+                               cotyledon-ctl command
+        :type control_socket: str
+        :param metrics_address: (host, port) tuple or path of a unix socket
+                                where the master serves the metrics of the
+                                workers over HTTP, in the Prometheus or
+                                OpenMetrics text format
+        :type metrics_address: tuple or str
+        :param metrics_textfile: file where the master periodically writes
+                                 the metrics of the workers, for the textfile
+                                 collector of the node_exporter
+        :type metrics_textfile: str
+        :raises: ValueError
         """
 
+        if start_concurrency is not None and (
+                isinstance(start_concurrency, bool) or
+                not isinstance(start_concurrency, numbers.Integral) or
+                start_concurrency <= 0):
+            raise ValueError("start_concurrency must be an integer greater "
+                             "than 0")
+        if not 0 < ready_ratio <= 1:
+            raise ValueError("ready_ratio must be greater than 0 and lower "
+                             "or equal to 1")
+
         if self._process_runner_already_created:
             raise RuntimeError("Only one instance of ProcessRunner per "
                                "application is allowed")
         ServiceManager._process_runner_already_created = True
+        self._master_pid = os.getpid()
 
         self._wait_interval = wait_interval
+        self._start_concurrency = start_concurrency
+        self._ready_ratio = ready_ratio
+        self._stats_path = stats_path
+        self._stats_board = None
+        # NOTE: Only the master process talks to systemd
+        self._notify_socket = os.environ.pop('NOTIFY_SOCKET', None)
+        self._watchdog_interval = self._get_watchdog_interval()
+        self._healthy = True
+        self._ready_notified = False
+        self._reload_requested = False
         self._shutdown = threading.Event()
 
         self._running_services = collections.defaultdict(dict)
-        self._services = []
-        self._forktimes = []
+        # pid -> (config, worker_id) index of all running children
+        self._pids = {}
+        self._services = collections.OrderedDict()
+        self._slots = {}
+        self._timers = []
+        self._timer_ids = itertools.count()
         self._current_process = None
+        self._hooks = {
+            'preload': [],
+            'fork': [],
+            'worker_ready': [],
+            'worker_exit': [],
+            'reload': [],
+            'shutdown': [],
+        }
+
+        # pids of the workers that are running Service.__init__
+        self._initializing = set()
+        # pid -> config of the running zygotes and spares
+        self._zygotes = {}
+        self._spare_pids = {}
+        self._run_started_at = None
+        self._startup_duration = None
 
         # Try to create a session id if possible
         try:
@@ -217,12 +833,59 @@ class ServiceManager(object):
 
         self.readpipe, self.writepipe = os.pipe()
 
+        # NOTE: Self-pipe used to wake up the supervision loop, the
+        # signal module writes the signal number into it each time a signal
+        # with a python handler is received.
+        self._signal_pipe_r, self._signal_pipe_w = os.pipe()
+        _set_nonblocking(self._signal_pipe_r)
+        _set_nonblocking(self._signal_pipe_w)
+        signal.set_wakeup_fd(self._signal_pipe_w)
+
+        # NOTE: epoll doesn't scan all the registered fds on each wake up,
+        # that matters with a pidfd per worker
+        self._epoll = hasattr(select, 'epoll')
+        self._poller = select.epoll() if self._epoll else select.poll()
+        self._fd_handlers = {}
+        self._register_fd(self._signal_pipe_r, self._drain_signal_pipe)
+
+        # Pipe shared by all children to send _STATUS_MSG to the master
+        self._status_pipe_r, self._status_pipe_w = os.pipe()
+        _set_nonblocking(self._status_pipe_r)
+        self._status_buffer = b''
+        self._register_fd(self._status_pipe_r, self._read_status_pipe)
+
+        # NOTE: On Linux >= 5.3 each child get a pidfd registered in
+        # the poller, so we know exactly which children have exited. None
+        # means that we fallback to SIGCHLD and waitpid(0, WNOHANG).
+        self._pidfds = {} if self._pidfd_supported() else None
+        self._exited_pids = set()
+        # Watched children that have been reaped by someone else
+        self._lost_children = set()
+        # Orphaned descendants of the workers are reparented to the master
+        self._subreaper = False
+
+        self._control = None
+        if control_socket is not None:
+            self._control = _control._ControlServer(self, control_socket)
+
+        self._metrics = None
+        if metrics_address is not None or metrics_textfile is not None:
+            self._metrics = _metrics._MetricsExporter(self, metrics_address,
+                                                      metrics_textfile)
+
         signal.signal(signal.SIGTERM, self._clean_exit)
         signal.signal(signal.SIGINT, self._fast_exit)
         signal.signal(signal.SIGALRM, self._alarm_exit)
         signal.signal(signal.SIGHUP, self._reload_services)
-
-    def add(self, service, workers=1, args=None, kwargs=None):
+        if self._pidfds is None:
+            signal.signal(signal.SIGCHLD, self._child_exited)
+
+    def add(self, service, workers=1, args=None, kwargs=None,
+            reload_batch=None, autoscale=None, zygote=False, preload=None,
+            spares=0, listen=None, reuseport=False, backlog=None,
+            tasks=None, heartbeat_timeout=None, max_rss=None, max_age=None,
+            max_tasks=None, cpu_affinity=None, shutdown_timeout=None,
+            shutdown_group=0, max_workers=None):
         """Add a new service to the ServiceManager
 
         :param service: callable that return an instance of :py:class:`Service`
@@ -233,8 +896,323 @@ class ServiceManager(object):
         :type args: tuple
         :param kwargs: additional keywoard arguments for this service
         :type kwargs: dict
+        :param reload_batch: on SIGHUP, reload the workers of this service by
+                             batches of this size, each batch waiting for the
+                             previous one to be ready again. By default all
+                             workers are reloaded at once.
+        :type reload_batch: int
+        :param autoscale: adjust the number of workers with this policy,
+                          `workers` is then the initial number of workers
+        :type autoscale: :py:class:`AutoscalePolicy`
+        :param zygote: fork the workers of this service from a dedicated
+                       process (a zygote) started once by the master, instead
+                       of the master itself. Respawns are then not slowed down
+                       by the memory used by the master and the other
+                       services. Requires Linux >= 3.4, otherwise workers are
+                       forked from the master.
+        :type zygote: bool
+        :param preload: method called once before forking the workers of this
+                        service, in the zygote if enabled, otherwise in the
+                        master process like the `on_preload` hooks.
+        :type preload: callable()
+        :param spares: number of extra workers kept initialised but parked
+                       before :py:meth:`Service.run`. When a worker dies, a
+                       spare takes its worker_id right away and a new spare is
+                       started. Spares are initialised with a worker_id of -1.
+        :type spares: int
+        :param listen: addresses to listen on, (host, port) tuples or paths of
+                       unix sockets. They are bound right away by the master
+                       process and the resulting sockets are available to the
+                       workers with :py:attr:`Service.listen_sockets`. As the
+                       master keeps them open, no connections are refused
+                       while workers are restarted or reloaded.
+        :type listen: list
+        :param reuseport: instead of sharing the listening sockets, each
+                          worker listens on its own socket with SO_REUSEPORT
+                          and the kernel balances the connections between
+                          them. The master only binds the addresses to
+                          reserve them. Connections queued on the socket of
+                          a dying worker are lost.
+        :type reuseport: bool
+        :param backlog: the listen backlog of the sockets, defaults to
+                        SOMAXCONN
+        :type backlog: int
+        :param tasks: queue of the tasks processed by this service, which
+                      must be a :py:class:`TaskService`. Services with a task
+                      queue can't use zygote or spares.
+        :type tasks: :py:class:`TaskQueue`
+        :param heartbeat_timeout: kill and restart the workers that don't call
+                                  :py:meth:`Service.heartbeat` during this
+                                  number of seconds once ready
+        :type heartbeat_timeout: float
+        :param max_rss: gracefully restart the workers using more resident
+                        memory than this number of bytes
+        :type max_rss: int
+        :param max_age: gracefully restart the workers running for more than
+                        this number of seconds
+        :type max_age: float
+        :param max_tasks: gracefully restart the workers that have reported
+                          more than this number of tasks with
+                          :py:meth:`Service.task_done`
+        :type max_tasks: int
+        :param cpu_affinity: pin the workers to CPUs, by worker_id so a
+                             restarted worker gets the same CPUs.
+                             'round-robin' pins each worker to one of the
+                             CPUs available, 'numa' pins each worker to all
+                             CPUs of one NUMA node, spreading the workers
+                             over the nodes. A list pins each worker to one
+                             of its items, a CPU number or a list of CPU
+                             numbers. Requires Python >= 3.3.
+        :type cpu_affinity: str or list
+        :param shutdown_timeout: on shutdown, time in seconds given to the
+                                 workers to exit after SIGTERM before being
+                                 killed with SIGKILL. By default the workers
+                                 are waited forever.
+        :type shutdown_timeout: float
+        :param shutdown_group: on shutdown, services are stopped by group,
+                               by ascending group number, each group waiting
+                               for the previous one to be stopped. For
+                               example consumers can be stopped before the
+                               services they depend on.
+        :type shutdown_group: int
+        :param max_workers: maximum number of workers the service can be
+                            scaled to with :py:meth:`reconfigure` once the
+                            ServiceManager runs, `workers` by default. The
+                            shared memory of the stats has a slot for each.
+        :type max_workers: int
+        :return: a service id
+        :rtype: uuid.UUID
+        :raises: socket.error, ValueError
+        """
+        if max_workers is not None and max_workers < workers:
+            raise ValueError("max_workers must be greater than or equal to "
+                             "workers")
+        if heartbeat_timeout is not None and heartbeat_timeout <= 0:
+            raise ValueError("heartbeat_timeout must be greater than 0")
+        if reload_batch is not None and (
+                isinstance(reload_batch, bool) or
+                not isinstance(reload_batch, numbers.Integral) or
+                reload_batch <= 0):
+            raise ValueError("reload_batch must be an integer greater than 0")
+        for name, limit in (('max_rss', max_rss), ('max_age', max_age),
+                            ('max_tasks', max_tasks),
+                            ('shutdown_timeout', shutdown_timeout)):
+            if limit is not None and limit <= 0:
+                raise ValueError("%s must be greater than 0" % name)
+        cpu_sets = None
+        if cpu_affinity is not None:
+            cpu_sets = _get_cpu_sets(cpu_affinity)
+        if tasks is not None:
+            if zygote or spares:
+                raise ValueError("services with a task queue can't use "
+                                 "zygote or spares")
+            tasks._attach(self)
+        if reuseport and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        backlog = backlog or socket.SOMAXCONN
+        sockets = []
+        try:
+            for address in listen or []:
+                sock = _bind_socket(address, reuseport)
+                sockets.append(sock)
+                if not reuseport:
+                    sock.listen(backlog)
+        except Exception:
+            for sock in sockets:
+                sock.close()
+            raise
+        service_id = uuid.uuid4()
+        if autoscale is not None:
+            workers = autoscale.get_workers(workers, None)
+        self._services[service_id] = _ServiceConfig(
+            service_id, service, workers, args, kwargs, reload_batch,
+            autoscale, zygote, preload, spares, sockets, reuseport, backlog,
+            tasks, heartbeat_timeout, max_rss, max_age, max_tasks, cpu_sets,
+            shutdown_timeout, shutdown_group, max_workers=max_workers)
+        return service_id
+
+    def reconfigure(self, service_id, workers):
+        """Change the number of workers of a service
+
+        It can be called before :py:meth:`run` or from the master process
+        while it runs, for example from a signal handler or a thread. New
+        worker_ids are started to scale up, the highest worker_ids are
+        gracefully terminated to scale down.
+
+        :param service_id: the service id returned by :py:meth:`add`
+        :type service_id: uuid.UUID
+        :param workers: number of processes/workers for this service, at
+                        most the `max_workers` passed to :py:meth:`add`
+                        once the ServiceManager runs. For an autoscaled
+                        service, it must be within the bounds of its
+                        :py:class:`AutoscalePolicy`, which adjusts it again
+                        once its cooldown has elapsed.
+        :type workers: int
+        :raises: ValueError
+        """
+        try:
+            conf = self._services[service_id]
+        except KeyError:
+            raise ValueError("%s service id doesn't exists" % service_id)
+        if (isinstance(workers, bool) or
+                not isinstance(workers, numbers.Integral) or workers <= 0):
+            raise ValueError("the number of workers must be an integer "
+                             "greater than 0")
+        # NOTE: The stats board is sized when the ServiceManager starts,
+        # workers without a slot would escape the stats, heartbeat and
+        # max_tasks checks
+        if conf.stats_first is not None and workers > conf.stats_slots:
+            raise ValueError("%s can't be scaled above %d workers, see the "
+                             "max_workers option" % (self._service_name(conf),
+                                                     conf.stats_slots))
+        if conf.autoscale is not None:
+            if not (conf.autoscale.min_workers <= workers <=
+                    conf.autoscale.max_workers):
+                raise ValueError("%s is autoscaled between %d and %d workers"
+                                 % (self._service_name(conf),
+                                    conf.autoscale.min_workers,
+                                    conf.autoscale.max_workers))
+            conf.autoscaled_at = _monotonic()
+        conf.workers = workers
+        self._wakeup()
+
+    def register_hooks(self, on_preload=None, on_fork=None,
+                       on_worker_ready=None, on_worker_exit=None,
+                       on_reload=None, on_shutdown=None):
+        """Register hook methods
+
+        This can be called multiple times to add more hooks, hooks are
+        executed in added order.
+
+        All hooks are called in the master process. Durations are in seconds
+        and measured with a monotonic clock, exceptions raised by the hooks
+        are logged and ignored, except for `on_preload`.
+
+        :param on_preload: method called once in the master process before
+                           any worker is forked, to import modules or load
+                           read-only data shared by all workers. The garbage
+                           collector is then frozen (Python >= 3.7) to keep
+                           this memory shared between workers.
+        :type on_preload: callable()
+        :param on_fork: method called when a new worker process is started,
+                        with the time taken to get its process: the fork, or
+                        the request to the zygote or to a spare worker
+        :type on_fork: callable(service_id, worker_id, pid, fork_duration)
+        :param on_worker_ready: method called when a worker is ready, with the
+                                time from its fork to the end of its
+                                :py:meth:`Service.__init__`
+        :type on_worker_ready: callable(service_id, worker_id, pid,
+                                        init_duration)
+        :param on_worker_exit: method called when a worker has exited, with
+                               its exit status as returned by
+                               :py:func:`os.waitpid` and its uptime
+        :type on_worker_exit: callable(service_id, worker_id, pid, status,
+                                       runtime)
+        :param on_reload: method called when the reload of all services is
+                          requested
+        :type on_reload: callable()
+        :param on_shutdown: method called when the shutdown starts
+        :type on_shutdown: callable()
+        """
+        for name, hook in (('preload', on_preload), ('fork', on_fork),
+                           ('worker_ready', on_worker_ready),
+                           ('worker_exit', on_worker_exit),
+                           ('reload', on_reload),
+                           ('shutdown', on_shutdown)):
+            if hook is not None:
+                self._hooks[name].append(hook)
+
+    def _run_hooks(self, name, *args):
+        for hook in self._hooks[name]:
+            try:
+                hook(*args)
+            except Exception:
+                LOG.exception('Unhandled exception in %s hook', name)
+
+    def _preload(self):
+        self._run_preloads(self._hooks['preload'] + [
+            conf.preload for conf in self._services.values()
+            if conf.preload is not None and not conf.zygote])
+
+    @staticmethod
+    def _run_preloads(preloads):
+        if not preloads:
+            # NOTE: Without preload, the objects of the application stay
+            # collectable
+            return
+        # NOTE: Avoid to create holes in memory pages while loading
+        # and move everything allocated so far out of the reach of the
+        # garbage collector, so workers don't touch (and copy) these pages
+        # when they collect.
+        gc.disable()
+        try:
+            for preload in preloads:
+                preload()
+        finally:
+            if hasattr(gc, 'freeze'):
+                gc.freeze()
+            gc.enable()
+
+    @property
+    def startup_duration(self):
+        """Time in seconds to get all workers initialised at startup
+
+        None until all the workers have returned from their
+        :py:meth:`Service.__init__`.
         """
-        self._services.append(_ServiceConfig(service, workers, args, kwargs))
+        return self._startup_duration
+
+    def workers_info(self):
+        """Return information about the running workers
+
+        Only meaningful in the master process, for example from a signal
+        handler.
+
+        :return: a list of dict with the service name, worker_id, pid, ready
+                 state, init latency (time from the fork to the readiness
+                 of the worker in seconds, None if not ready yet) and
+                 memory usage (rss, shared and private memory in bytes, None
+                 if unavailable) of each worker
+        """
+        workers = []
+        for pid, (conf, worker_id) in sorted(self._pids.items()):
+            slot = self._get_slot(conf, worker_id)
+            ready = slot.ready_at is not None
+            try:
+                memory = _get_memory_usage(pid)
+            except EnvironmentError:
+                memory = dict(rss=None, shared=None, private=None)
+            info = dict(
+                service=self._service_name(conf),
+                worker_id=worker_id,
+                pid=pid,
+                ready=ready,
+                init_latency=(slot.ready_at - slot.started_at
+                              if ready else None),
+            )
+            info.update(memory)
+            workers.append(info)
+        return workers
+
+    def stats(self):
+        """Return the stats of the services, summed over their workers
+
+        Only meaningful in the master process. Stats of the workers are
+        updated with :py:attr:`Service.worker_stats`, the ones of the stopped
+        workers are still counted.
+
+        :return: a dict of service name -> dict of stat name -> value
+        """
+        services = collections.defaultdict(dict)
+        if self._stats_board is None:
+            return {}
+        for conf in self._services.values():
+            totals = services[self._service_name(conf)]
+            for index in range(conf.stats_first,
+                               conf.stats_first + conf.stats_slots):
+                for name, value in self._stats_board.get_stats(index).items():
+                    totals[name] = totals.get(name, 0) + value
+        return dict(services)
 
     def run(self):
         """Start and supervise services
@@ -245,69 +1223,825 @@ class ServiceManager(object):
         All spawned processes are part of the same unix process group.
         """
 
-        self._systemd_notify_once()
+        self._preload()
+        self._create_stats_board()
+        for conf in self._services.values():
+            if conf.spares:
+                conf.spare_read_fd, conf.spare_write_fd = os.pipe()
+        self._start_zygotes()
+        self._run_started_at = _monotonic()
+        self._notify_ready_if_needed()
+        for conf in self._services.values():
+            if conf.autoscale is not None:
+                self._call_later(conf.autoscale.interval,
+                                 functools.partial(self._autoscale, conf))
+            if conf.heartbeat_timeout is not None:
+                self._call_later(conf.heartbeat_timeout / 4.0,
+                                 functools.partial(self._check_heartbeats,
+                                                   conf))
+        if any(conf.max_rss or conf.max_age or conf.max_tasks
+               for conf in self._services.values()):
+            self._call_later(_RECYCLE_INTERVAL, self._recycle_workers)
+        if self._watchdog_interval is not None:
+            self._watchdog()
+        if self._metrics is not None:
+            self._metrics.start()
         while not self._shutdown.is_set():
-            info = self._wait_service()
-            if info is not None:
-                # Restart this particular service
-                conf, worker_id = info
-            else:
-                for conf in self._services:
-                    if len(self._running_services[conf]) < conf.workers:
-                        worker_id = len(self._running_services[conf])
-                        break
+            # Restart all died services at once, then fork the missing ones
+            for conf, worker_id, status in self._wait_services():
+                self._respawn_worker(conf, worker_id, status)
+            self._stop_extra_workers()
+            self._start_missing_workers()
+            self._start_missing_spares()
+            self._dispatch_tasks()
+            if self._reload_requested:
+                self._reload_requested = False
+                self._start_rolling_reload()
+            self._wait_for_events()
+
+        self._run_hooks('shutdown')
+
+        # NOTE: Nothing to start, scale or check anymore
+        self._timers = []
+        groups = sorted(set(conf.shutdown_group
+                            for conf in self._services.values()))
+        for i, group in enumerate(groups):
+            self._stop_services([conf for conf in self._services.values()
+                                 if conf.shutdown_group == group],
+                                last=i == len(groups) - 1)
+
+        if self._control is not None:
+            self._control.close()
+        if self._metrics is not None:
+            self._metrics.close()
+        for conf in self._services.values():
+            for sock in conf.sockets:
+                if sock.family == socket.AF_UNIX:
+                    try:
+                        os.unlink(sock.getsockname())
+                    except OSError:
+                        pass
+                sock.close()
+
+        LOG.debug("Shutdown finish")
+        sys.exit(0)
+
+    def _create_stats_board(self):
+        slots = 0
+        for conf in self._services.values():
+            conf.stats_first = slots
+            conf.stats_slots = max(conf.workers, conf.max_workers or 0)
+            if conf.autoscale is not None:
+                conf.stats_slots = max(conf.stats_slots,
+                                       conf.autoscale.max_workers)
+            slots += conf.stats_slots
+        self._stats_board = _stats._StatsBoard(slots, self._stats_path)
+
+    def _set_stats_pid(self, conf, worker_id, pid):
+        if self._stats_board is not None and worker_id < conf.stats_slots:
+            self._stats_board.assign(conf.stats_first + worker_id, pid,
+                                     worker_id, self._service_name(conf))
+
+    def _get_slot(self, conf, worker_id):
+        slot = self._slots.get((conf, worker_id))
+        if slot is None:
+            slot = self._slots[(conf, worker_id)] = _WorkerSlot()
+        return slot
+
+    def _start_worker(self, conf, worker_id, promote=True):
+        slot = self._get_slot(conf, worker_id)
+        slot.respawn_timer = None
+        slot.stopping = False
+        slot.started_at = _monotonic()
+        slot.initialized_at = None
+        self._clear_ready(conf, slot)
+        slot.load = slot.cpu_sample = None
+        slot.recycle_factor = random.uniform(1 - _RECYCLE_JITTER, 1)
+        if promote and len(conf.spares_ready) > len(conf.promotions):
+            slot.spawning = True
+            conf.promotions[worker_id] = self._call_later(
+                _SPARE_PROMOTION_TIMEOUT,
+                functools.partial(self._promotion_timeout, conf, worker_id))
+            os.write(conf.spare_write_fd, _WORKER_ID.pack(worker_id))
+        elif conf.zygote_pid is not None:
+            slot.spawning = True
+            self._request_zygote_fork(conf, worker_id)
+        else:
+            self._add_worker(conf, worker_id,
+                             self._start_service(conf, worker_id))
+
+    def _start_missing_spares(self):
+        if self._initializing:
+            # NOTE: workers first
+            return
+        for conf in self._services.values():
+            missing = conf.spares - len(conf.spare_pids) - len(
+                [worker_id for worker_id in conf.zygote_requests
+                 if worker_id == _SPARE_WORKER_ID])
+            if missing <= 0:
+                continue
+            # NOTE: The spares of a service share a slot for the backoff of
+            # the ones dying before their promotion
+            slot = self._get_slot(conf, _SPARE_WORKER_ID)
+            if slot.respawn_timer is not None:
+                continue
+            slot.started_at = _monotonic()
+            for i in range(missing):
+                if conf.zygote_pid is not None:
+                    self._request_zygote_fork(conf, _SPARE_WORKER_ID)
                 else:
-                    time.sleep(self._wait_interval)
-                    continue
+                    self._add_spare(conf, self._start_service(
+                        conf, _SPARE_WORKER_ID))
 
-            pid = self._start_service(conf, worker_id)
-            self._running_services[conf][pid] = worker_id
+    @staticmethod
+    def _request_zygote_fork(conf, worker_id):
+        conf.zygote_requests.append(worker_id)
+        try:
+            os.write(conf.zygote_fd, _WORKER_ID.pack(worker_id))
+        except OSError as exc:
+            # NOTE: The zygote has died and is not reaped yet, the request
+            # is dropped by _zygote_exited()
+            if exc.errno != errno.EPIPE:
+                raise
 
-        LOG.debug("Killing services with signal SIGTERM")
-        os.killpg(0, signal.SIGTERM)
+    def _add_spare(self, conf, pid):
+        conf.spare_pids.add(pid)
+        self._spare_pids[pid] = conf
+        self._watch_child(pid)
+
+    def _promote_spare(self, conf, pid, worker_id):
+        conf.spares_ready.discard(pid)
+        timer = conf.promotions.pop(worker_id, None)
+        if timer is None:
+            # NOTE: The promotion has timed out and the worker has
+            # been started by another way. It's reaped as a spare.
+            LOG.warning('Spare %(pid)d of service %(name)s promoted too late',
+                        dict(pid=pid, name=self._service_name(conf)))
+            self._kill_worker(pid, signal.SIGTERM)
+            return
+        conf.spare_pids.discard(pid)
+        del self._spare_pids[pid]
+        self._cancel_timer(timer)
+        self._add_worker(conf, worker_id, pid)
+        self._initializing.discard(pid)
+        self._get_slot(conf, worker_id).initialized_at = _monotonic()
+
+    def _promotion_timeout(self, conf, worker_id):
+        LOG.warning('No spare of service %(name)s took worker_id '
+                    '%(worker_id)d, forking it',
+                    dict(name=self._service_name(conf), worker_id=worker_id))
+        del conf.promotions[worker_id]
+        self._get_slot(conf, worker_id).spawning = False
+        if worker_id < conf.workers:
+            # NOTE: Not through another spare, it may be stuck the same way
+            self._start_worker(conf, worker_id, promote=False)
+
+    def _add_worker(self, conf, worker_id, pid):
+        slot = self._get_slot(conf, worker_id)
+        slot.spawning = False
+        slot.pid = pid
+        self._set_stats_pid(conf, worker_id, pid)
+        self._running_services[conf][pid] = worker_id
+        self._pids[pid] = (conf, worker_id)
+        self._initializing.add(pid)
+        self._watch_child(pid)
+        if slot.failures:
+            self._call_later(_RESPAWN_STABLE_UPTIME, functools.partial(
+                self._worker_stable, conf, worker_id, pid))
+        self._run_hooks('fork', conf.service_id, worker_id, pid,
+                        _monotonic() - slot.started_at)
+
+    def _respawn_worker(self, conf, worker_id, status):
+        if worker_id >= conf.workers:
+            # NOTE: The service has been scaled down
+            timer = conf.reloading.pop(worker_id, None)
+            if timer is not None:
+                self._cancel_timer(timer)
+                self._reload_next_batch(conf)
+            return
+        slot = self._get_slot(conf, worker_id)
+        slot.restarts += 1
+        delay = slot.next_respawn_delay(_monotonic(), status)
+        self._check_crash_loop(conf)
+        # NOTE: Without delay, the worker is started with the missing
+        # ones in the same loop iteration
+        if delay > 0:
+            LOG.info('%(name)s(%(worker_id)d) is dying too fast, respawning '
+                     'it in %(delay).1fs',
+                     dict(name=self._service_name(conf), worker_id=worker_id,
+                          delay=delay))
+            slot.respawn_timer = self._call_later(
+                delay, functools.partial(self._start_delayed_worker, conf,
+                                         worker_id))
+
+    def _respawn_spare(self, conf, status):
+        slot = self._get_slot(conf, _SPARE_WORKER_ID)
+        delay = slot.next_respawn_delay(_monotonic(), status)
+        if delay > 0 and slot.respawn_timer is None:
+            LOG.info('Spares of %(name)s are dying too fast, respawning them '
+                     'in %(delay).1fs',
+                     dict(name=self._service_name(conf), delay=delay))
+            slot.respawn_timer = self._call_later(
+                delay, functools.partial(self._spare_backoff_expired, conf))
+
+    def _spare_backoff_expired(self, conf):
+        # NOTE: The missing spares are started in the same loop iteration
+        self._get_slot(conf, _SPARE_WORKER_ID).respawn_timer = None
+
+    def _worker_stable(self, conf, worker_id, pid):
+        slot = self._get_slot(conf, worker_id)
+        if slot.pid == pid:
+            slot.failures = 0
+            self._check_crash_loop(conf)
+
+    def _start_delayed_worker(self, conf, worker_id):
+        self._get_slot(conf, worker_id).respawn_timer = None
+        if worker_id < conf.workers:
+            self._start_worker(conf, worker_id)
+
+    def _check_crash_loop(self, conf):
+        degraded = any(self._get_slot(conf, worker_id).failures >=
+                       _RESPAWN_CRASH_LOOP
+                       for worker_id in range(conf.workers))
+        if degraded and not conf.degraded:
+            LOG.warning('Service %s is crash looping, marking it as degraded',
+                        self._service_name(conf))
+        elif not degraded and conf.degraded:
+            LOG.info('Service %s has recovered', self._service_name(conf))
+        conf.degraded = degraded
 
-        LOG.debug("Waiting services to terminate")
-        # NOTE(sileht): We follow the termination of our children only
-        # so we can't use waitpid(0, 0)
-        for conf in self._services:
-            for pid in self._running_services[conf]:
-                try:
-                    os.waitpid(pid, 0)
-                except OSError as e:
-                    if e.errno == errno.ECHILD:
-                        pass
-                    else:
-                        raise
+    @staticmethod
+    def _service_name(conf):
+        return (getattr(conf.service, 'name', None) or
+                getattr(conf.service, '__name__', None) or
+                repr(conf.service))
+
+    def _stop_extra_workers(self):
+        for conf in self._services.values():
+            for pid, worker_id in self._running_services[conf].items():
+                slot = self._get_slot(conf, worker_id)
+                if worker_id >= conf.workers and not slot.stopping:
+                    slot.stopping = True
+                    self._kill_worker(pid, signal.SIGTERM)
+
+    def _start_missing_workers(self):
+        for conf in self._services.values():
+            running = self._running_services[conf]
+            if len(running) >= conf.workers:
+                continue
+            running_ids = set(running.values())
+            for worker_id in range(conf.workers):
+                slot = self._get_slot(conf, worker_id)
+                if (worker_id not in running_ids and
+                        slot.respawn_timer is None and not slot.spawning):
+                    if (self._start_concurrency is not None and
+                            self._starting_count() >=
+                            self._start_concurrency):
+                        return
+                    self._start_worker(conf, worker_id)
+
+    def _starting_count(self):
+        return len(self._initializing) + sum(
+            len(conf.zygote_requests) for conf in self._services.values())
+
+    def _start_zygotes(self):
+        if not any(conf.zygote for conf in self._services.values()):
+            return
+        # NOTE: Workers are double forked by the zygotes, becoming
+        # orphans, they are then reparented to us, so we can reap them.
+        if not _prctl(_PR_SET_CHILD_SUBREAPER, 1):
+            LOG.warning("Can't become a child subreaper, zygotes are "
+                        "disabled")
+            for conf in self._services.values():
+                if conf.zygote:
+                    self._disable_zygote(conf)
+            return
+        self._subreaper = True
+        # NOTE: The pidfds only watch our workers, the processes they
+        # daemonize are reaped on SIGCHLD
+        signal.signal(signal.SIGCHLD, self._child_exited)
+        for conf in self._services.values():
+            if conf.zygote:
+                self._start_zygote(conf)
+
+    def _start_zygote(self, conf):
+        readfd, writefd = os.pipe()
+        pid = os.fork()
+        if pid != 0:
+            os.close(readfd)
+            conf.zygote_pid = pid
+            conf.zygote_fd = writefd
+            conf.zygote_started_at = _monotonic()
+            self._zygotes[pid] = conf
+            self._watch_child(pid)
+            return
 
-        LOG.debug("Shutdown finish")
-        sys.exit(0)
+        os.close(writefd)
+        self._reset_master_state()
+        # NOTE: a reload is only for workers
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        setproctitle.setproctitle("%(pname)s - %(name)s zygote" % dict(
+            pname=os.path.basename(sys.argv[0]),
+            name=self._service_name(conf)))
+
+        with _exit_on_exception():
+            if conf.preload is not None:
+                self._run_preloads([conf.preload])
+
+            zygote_pid = os.getpid()
+            while True:
+                data = _read_exactly(readfd, _WORKER_ID.size)
+                if data is None:
+                    # The master process is gone
+                    os._exit(0)
+                worker_id = _WORKER_ID.unpack(data)[0]
+                pid = os.fork()
+                if pid == 0:
+                    intermediate_pid = os.getpid()
+                    if os.fork() == 0:
+                        os.close(readfd)
+                        os.write(_status_fd, _STATUS_MSG.pack(
+                            zygote_pid, _STATUS_FORKED, os.getpid()))
+                        # NOTE: Wait to be reparented to the master
+                        # before setting up the parent death signal
+                        while os.getppid() == intermediate_pid:
+                            time.sleep(0.001)
+                        self._run_service(conf, worker_id)
+                    os._exit(0)
+                os.waitpid(pid, 0)
+
+    def _zygote_exited(self, conf):
+        del self._zygotes[conf.zygote_pid]
+        os.close(conf.zygote_fd)
+        for worker_id in conf.zygote_requests:
+            if worker_id != _SPARE_WORKER_ID:
+                self._get_slot(conf, worker_id).spawning = False
+        conf.zygote_requests.clear()
+        conf.zygote_pid = conf.zygote_fd = None
+        if _monotonic() - conf.zygote_started_at < _RESPAWN_BACKOFF_MIN:
+            LOG.error('Zygote of service %s is dying too fast, forking its '
+                      'workers from the master process',
+                      self._service_name(conf))
+            try:
+                self._disable_zygote(conf)
+            except Exception:
+                LOG.exception('Unhandled exception in the preload of '
+                              'service %s', self._service_name(conf))
+        else:
+            self._start_zygote(conf)
+
+    def _disable_zygote(self, conf):
+        """Fork the workers of the service from the master from now on"""
+        conf.zygote = False
+        if conf.preload is not None:
+            self._run_preloads([conf.preload])
+
+    def _read_status_pipe(self):
+        while True:
+            try:
+                data = os.read(self._status_pipe_r, 4096)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            self._status_buffer += data
+
+        size = _STATUS_MSG.size
+        count = len(self._status_buffer) // size
+        for i in range(count):
+            self._handle_status(*_STATUS_MSG.unpack_from(
+                self._status_buffer, i * size))
+        self._status_buffer = self._status_buffer[count * size:]
+
+    def _handle_status(self, pid, kind, value):
+        if kind == _STATUS_FORKED:
+            conf = self._zygotes.get(pid)
+            if conf is not None and conf.zygote_requests:
+                worker_id = conf.zygote_requests.popleft()
+                if worker_id == _SPARE_WORKER_ID:
+                    self._add_spare(conf, int(value))
+                else:
+                    self._add_worker(conf, worker_id, int(value))
+            return
+
+        conf = self._spare_pids.get(pid)
+        if conf is not None:
+            if kind == _STATUS_STARTED:
+                conf.spares_ready.add(pid)
+            elif kind == _STATUS_PROMOTED:
+                self._promote_spare(conf, pid, int(value))
+            return
 
-    def _wait_service(self):
-        """Return the last died service or None"""
+        info = self._pids.get(pid)
+        if info is None:
+            # NOTE: The child has already been reaped
+            return
+        slot = self._get_slot(*info)
+        if kind == _STATUS_STARTED:
+            self._initializing.discard(pid)
+            slot.initialized_at = _monotonic()
+            if self._startup_duration is None and self._all_initialized():
+                self._startup_duration = (slot.initialized_at -
+                                          self._run_started_at)
+        elif kind == _STATUS_LOAD:
+            slot.load = value
+        elif kind == _STATUS_TASK_DONE:
+            info[0].tasks._task_done(pid, int(value))
+        elif kind == _STATUS_READY:
+            conf, worker_id = info
+            if slot.ready_at is None:
+                slot.ready_at = _monotonic()
+                conf.ready_workers += 1
+                self._notify_ready_if_needed()
+                self._run_hooks('worker_ready', conf.service_id, worker_id,
+                                pid, (slot.initialized_at or slot.ready_at) -
+                                slot.started_at)
+            if worker_id in conf.reloading:
+                self._cancel_timer(conf.reloading.pop(worker_id))
+                self._reload_next_batch(conf)
+
+    def _autoscale(self, conf):
+        self._call_later(conf.autoscale.interval,
+                         functools.partial(self._autoscale, conf))
+        load = self._get_service_load(conf)
+        now = _monotonic()
+        if (conf.autoscaled_at is not None and
+                now - conf.autoscaled_at < conf.autoscale.cooldown):
+            return
+        workers = conf.autoscale.get_workers(conf.workers, load)
+        if workers != conf.workers:
+            LOG.info('Scaling service %(name)s from %(old)d to %(new)d '
+                     'workers (load: %(load)s)',
+                     dict(name=self._service_name(conf), old=conf.workers,
+                          new=workers,
+                          load='unknown' if load is None else '%.2f' % load))
+            conf.workers = workers
+            conf.autoscaled_at = now
+
+    def _get_service_load(self, conf):
+        """Return the average load of the ready workers of a service"""
+        loads = []
+        now = _monotonic()
+        for pid, worker_id in self._running_services[conf].items():
+            slot = self._get_slot(conf, worker_id)
+            if conf.autoscale.metric == 'load':
+                load = slot.load
+            else:
+                try:
+                    cpu_time = _get_cpu_time(pid)
+                except EnvironmentError:
+                    continue
+                load = None
+                if slot.cpu_sample is not None:
+                    last_time, last_cpu_time = slot.cpu_sample
+                    if now > last_time:
+                        load = (cpu_time - last_cpu_time) / (now - last_time)
+                slot.cpu_sample = (now, cpu_time)
+            if slot.ready_at is not None and load is not None:
+                loads.append(load)
+        if loads:
+            return sum(loads) / len(loads)
+
+    def _clear_ready(self, conf, slot):
+        if slot.ready_at is not None:
+            slot.ready_at = None
+            conf.ready_workers -= 1
+
+    def _notify_ready_if_needed(self):
+        if self._ready_notified:
+            return
+        for conf in self._services.values():
+            if conf.ready_workers < math.ceil(conf.workers *
+                                              self._ready_ratio):
+                return
+        self._ready_notified = True
+        self._systemd_notify(b'READY=1')
+
+    def _check_heartbeats(self, conf):
+        self._call_later(conf.heartbeat_timeout / 4.0,
+                         functools.partial(self._check_heartbeats, conf))
+        now = _monotonic()
+        for pid, worker_id in self._running_services[conf].items():
+            slot = self._get_slot(conf, worker_id)
+            if slot.ready_at is None or worker_id >= conf.stats_slots:
+                continue
+            last = max(slot.ready_at, self._stats_board.get_heartbeat(
+                conf.stats_first + worker_id))
+            if now - last > conf.heartbeat_timeout:
+                LOG.error('%(name)s(%(worker_id)d) has missed its heartbeat '
+                          'for %(delay).1fs, killing it',
+                          dict(name=self._service_name(conf),
+                               worker_id=worker_id, delay=now - last))
+                self._kill_worker(pid, signal.SIGKILL)
+
+    def _recycle_workers(self):
+        self._call_later(_RECYCLE_INTERVAL, self._recycle_workers)
+        now = _monotonic()
+        for conf in self._services.values():
+            running = self._running_services[conf]
+            # NOTE: Recycle one worker at a time per service, once
+            # the previous one has been replaced
+            if len(running) < conf.workers or any(
+                    self._get_slot(conf, worker_id).ready_at is None
+                    for worker_id in running.values()):
+                continue
+            candidates = []
+            for pid, worker_id in running.items():
+                slot = self._get_slot(conf, worker_id)
+                if slot.stopping:
+                    continue
+                usage = self._get_recycle_usage(conf, pid, worker_id, now)
+                for reason, (value, limit) in usage.items():
+                    ratio = value / (limit * slot.recycle_factor)
+                    if ratio >= 1:
+                        candidates.append((ratio, pid, worker_id, reason))
+            if candidates:
+                ratio, pid, worker_id, reason = max(candidates)
+                LOG.info('Recycling %(name)s(%(worker_id)d), %(reason)s '
+                         'limit reached',
+                         dict(name=self._service_name(conf),
+                              worker_id=worker_id, reason=reason))
+                self._get_slot(conf, worker_id).stopping = True
+                self._kill_worker(pid, signal.SIGTERM)
+
+    def _get_recycle_usage(self, conf, pid, worker_id, now):
+        """Return reason -> (value, limit) of the limits of a worker"""
+        usage = {}
+        if conf.max_age:
+            usage['max_age'] = (
+                now - self._get_slot(conf, worker_id).started_at,
+                conf.max_age)
+        if conf.max_tasks and worker_id < conf.stats_slots:
+            usage['max_tasks'] = (self._stats_board.get_tasks(
+                conf.stats_first + worker_id), conf.max_tasks)
+        if conf.max_rss:
+            try:
+                usage['max_rss'] = (_get_rss(pid), conf.max_rss)
+            except EnvironmentError:
+                pass
+        return usage
+
+    def _watchdog(self):
+        self._call_later(self._watchdog_interval, self._watchdog)
+        # NOTE: Hung workers are killed and restarted, so the tree is
+        # unhealthy only when a service can't stay up
+        healthy = not any(conf.degraded for conf in self._services.values())
+        if healthy:
+            self._systemd_notify(b'WATCHDOG=1')
+            if not self._healthy:
+                LOG.info('Services have recovered, resuming systemd '
+                         'watchdog notifications')
+        elif self._healthy:
+            LOG.warning('Services are degraded, stopping systemd watchdog '
+                        'notifications')
+        self._healthy = healthy
+
+    @staticmethod
+    def _get_watchdog_interval():
+        """Return the interval of the systemd watchdog notifications"""
+        usec = os.environ.pop('WATCHDOG_USEC', None)
+        pid = os.environ.pop('WATCHDOG_PID', None)
         try:
-            # Don't block if no child processes have exited
-            pid, status = os.waitpid(0, os.WNOHANG)
-            if not pid:
+            if not usec or (pid and int(pid) != os.getpid()):
                 return None
+            # NOTE: systemd recommends to notify at half the interval
+            return int(usec) / 2000000.0
+        except ValueError:
+            return None
+
+    def _all_initialized(self):
+        return not self._initializing and all(
+            len(self._running_services[conf]) >= conf.workers
+            for conf in self._services.values())
+
+    def _call_later(self, delay, callback):
+        timer = [_monotonic() + delay, next(self._timer_ids), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def _cancel_timer(timer):
+        timer[2] = None
+
+    def _run_timers(self):
+        now = _monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+
+    @staticmethod
+    def _pidfd_supported():
+        fd = _pidfd_open(os.getpid())
+        if fd is None:
+            return False
+        os.close(fd)
+        return True
+
+    def _register_fd(self, fd, callback, events=select.POLLIN):
+        self._fd_handlers[fd] = callback
+        if self._epoll:
+            events = ((select.EPOLLIN if events & select.POLLIN else 0) |
+                      (select.EPOLLOUT if events & select.POLLOUT else 0))
+        self._poller.register(fd, events)
+
+    def _unregister_fd(self, fd):
+        del self._fd_handlers[fd]
+        self._poller.unregister(fd)
+
+    def _wait_for_events(self):
+        """Block until a signal is received, a child exits or a timer fires"""
+        timeout = None
+        if self._timers:
+            timeout = max(0, int(math.ceil(
+                (self._timers[0][0] - _monotonic()) * 1000)))
+        try:
+            if self._epoll:
+                events = self._poller.poll(
+                    -1 if timeout is None else timeout / 1000.0)
+            else:
+                events = self._poller.poll(timeout)
+        except (select.error, IOError, OSError) as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            callback = self._fd_handlers.get(fd)
+            if callback is not None:
+                callback()
+        self._run_timers()
+
+    def _watch_child(self, pid):
+        if self._pidfds is None:
+            return
+        try:
+            fd = _pidfd_open(pid)
         except OSError as exc:
-            if exc.errno not in (errno.EINTR, errno.ECHILD):
+            if exc.errno != errno.ESRCH:
                 raise
-            return None
+            # NOTE: Worker forked by a zygote and already reaped as an
+            # orphan
+            return
+        if fd is None:
+            # NOTE: pidfd_open() has been disabled (ie: seccomp) since
+            # we start, fallback to SIGCHLD.
+            # NOTE: This also happens when we run out of file descriptors,
+            # a pidfd per worker may exceed RLIMIT_NOFILE
+            LOG.warning("Can't open a pidfd for child %d, falling back to "
+                        "SIGCHLD", pid)
+            for watched_pid in list(self._pidfds):
+                self._unwatch_child(watched_pid)
+            self._pidfds = None
+            self._exited_pids.clear()
+            signal.signal(signal.SIGCHLD, self._child_exited)
+            # NOTE: Children that exited before the handler was installed
+            # are reaped by the next iteration of the loop
+            self._wakeup()
+            return
+        self._pidfds[pid] = fd
+        self._register_fd(fd, functools.partial(self._exited_pids.add, pid))
 
-        if os.WIFSIGNALED(status):
-            sig = SIGNAL_TO_NAME.get(os.WTERMSIG(status))
-            LOG.info('Child %(pid)d killed by signal %(sig)s',
-                     dict(pid=pid, sig=sig))
-        else:
-            code = os.WEXITSTATUS(status)
-            LOG.info('Child %(pid)d exited with status %(code)d',
-                     dict(pid=pid, code=code))
+    def _unwatch_child(self, pid):
+        if self._pidfds is None:
+            return
+        fd = self._pidfds.pop(pid, None)
+        if fd is not None:
+            self._unregister_fd(fd)
+            os.close(fd)
 
-        for conf in self._running_services:
-            if pid in self._running_services[conf]:
-                return conf, self._running_services[conf].pop(pid)
+    def _wakeup(self):
+        """Wake up the supervision loop, from any thread"""
+        try:
+            os.write(self._signal_pipe_w, b'\0')
+        except OSError as exc:
+            # NOTE: A full pipe will wake up the loop anyway
+            if exc.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
 
-        LOG.error('pid %d not in service list', pid)
+    def _drain_signal_pipe(self):
+        while True:
+            try:
+                if not os.read(self._signal_pipe_r, 4096):
+                    break
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.EAGAIN:
+                    break
+                raise
+
+    def _child_exited(self, *args, **kwargs):
+        # NOTE: Nothing to do here, this handler only exists to get
+        # SIGCHLD written into the wakeup fd, children are reaped by the
+        # supervision loop
+        pass
+
+    def _reap_children(self):
+        """Return the pid and status of all died children"""
+        children = []
+        if self._pidfds is None or self._subreaper:
+            # NOTE: Orphans are reparented to the master with their own
+            # process group when they have daemonized
+            wait_pid = -1 if self._subreaper else 0
+            while True:
+                try:
+                    # Don't block if no child processes have exited
+                    pid, status = os.waitpid(wait_pid, os.WNOHANG)
+                except OSError as exc:
+                    if exc.errno == errno.EINTR:
+                        continue
+                    if exc.errno != errno.ECHILD:
+                        raise
+                    break
+                if not pid:
+                    break
+                self._unwatch_child(pid)
+                self._exited_pids.discard(pid)
+                children.append((pid, status))
+            return children
+
+        while self._exited_pids:
+            pid = self._exited_pids.pop()
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+                self._unwatch_child(pid)
+                self._lost_children.add(pid)
+                continue
+            if wpid:
+                self._unwatch_child(pid)
+                children.append((wpid, status))
+        return children
+
+    def _is_known_child(self, pid):
+        return (pid in self._pids or pid in self._zygotes or
+                pid in self._spare_pids)
+
+    def _wait_services(self):
+        """Return the config, worker_id and status of all died services"""
+        services = []
+        for pid, status in self._reap_children():
+            if self._subreaper and not self._is_known_child(pid):
+                # NOTE: The worker may have been forked by a zygote and
+                # died before we read its pid
+                self._read_status_pipe()
+                if not self._is_known_child(pid):
+                    LOG.debug('Reaped orphaned process %d', pid)
+                    continue
+
+            if os.WIFSIGNALED(status):
+                sig = SIGNAL_TO_NAME.get(os.WTERMSIG(status))
+                reason = str(sig)
+                LOG.info('Child %(pid)d killed by signal %(sig)s',
+                         dict(pid=pid, sig=sig))
+            else:
+                code = os.WEXITSTATUS(status)
+                reason = str(code)
+                LOG.info('Child %(pid)d exited with status %(code)d',
+                         dict(pid=pid, code=code))
+
+            if pid in self._zygotes:
+                self._zygote_exited(self._zygotes[pid])
+                continue
+
+            if pid in self._spare_pids:
+                conf = self._spare_pids.pop(pid)
+                conf.spare_pids.discard(pid)
+                conf.spares_ready.discard(pid)
+                self._respawn_spare(conf, status)
+                continue
+
+            if pid not in self._pids:
+                # NOTE: The worker may have been forked by a zygote
+                # and died before we read its pid
+                self._read_status_pipe()
+            info = self._pids.pop(pid, None)
+            if info is None:
+                LOG.error('pid %d not in service list', pid)
+                continue
+            self._initializing.discard(pid)
+            conf, worker_id = info
+            if conf.tasks is not None:
+                # NOTE: Get the last acknowledgements of the worker
+                # before requeuing its tasks
+                self._read_status_pipe()
+                conf.tasks._remove_worker(pid)
+            conf.exits[reason] += 1
+            slot = self._get_slot(conf, worker_id)
+            slot.pid = None
+            self._clear_ready(conf, slot)
+            self._set_stats_pid(conf, worker_id, 0)
+            del self._running_services[conf][pid]
+            self._run_hooks('worker_exit', conf.service_id, worker_id, pid,
+                            status, _monotonic() - slot.started_at)
+            services.append((conf, worker_id, status))
+        return services
 
     def _reload_services(self, *args, **kwargs):
         if self._shutdown.is_set():
@@ -315,12 +2049,72 @@ class ServiceManager(object):
             # to reload anything
             return
 
-        # Reset forktimes to respawn services quickly
-        self._forktimes = []
+        # Reset backoffs to respawn services quickly
+        for slot in self._slots.values():
+            slot.failures = 0
+        for conf in self._services.values():
+            self._check_crash_loop(conf)
+
+        self._run_hooks('reload')
+
+        if any(conf.reload_batch for conf in self._services.values()):
+            # NOTE: Rolling reloads are driven by the supervision loop
+            self._reload_requested = True
+            return
+
         signal.signal(signal.SIGHUP, signal.SIG_IGN)
         os.killpg(0, signal.SIGHUP)
         signal.signal(signal.SIGHUP, self._reload_services)
 
+    def _start_rolling_reload(self):
+        for conf in self._services.values():
+            self._reload_service(conf)
+
+    def _reload_service(self, conf):
+        if conf.reload_batch:
+            conf.reload_queue = collections.deque(
+                worker_id for worker_id in range(conf.workers)
+                if worker_id not in conf.reloading)
+            self._reload_next_batch(conf)
+        else:
+            for pid in list(self._running_services[conf]):
+                self._kill_worker(pid, signal.SIGHUP)
+        for pid in list(conf.spare_pids):
+            self._kill_worker(pid, signal.SIGHUP)
+
+    def _reload_next_batch(self, conf):
+        while conf.reload_queue and len(conf.reloading) < conf.reload_batch:
+            worker_id = conf.reload_queue.popleft()
+            slot = self._get_slot(conf, worker_id)
+            if slot.pid is None:
+                # NOTE: Not running, it will start with the new
+                # configuration anyways
+                continue
+            # The worker is ready again when it reports it after its
+            # Service.reload() or when its replacement is ready
+            self._clear_ready(conf, slot)
+            conf.reloading[worker_id] = self._call_later(
+                _ROLLING_RELOAD_TIMEOUT,
+                functools.partial(self._rolling_reload_timeout, conf,
+                                  worker_id))
+            self._kill_worker(slot.pid, signal.SIGHUP)
+
+    def _rolling_reload_timeout(self, conf, worker_id):
+        LOG.warning('%(name)s(%(worker_id)d) is not ready %(timeout)ds after '
+                    'its reload, continuing the rolling reload',
+                    dict(name=self._service_name(conf), worker_id=worker_id,
+                         timeout=_ROLLING_RELOAD_TIMEOUT))
+        del conf.reloading[worker_id]
+        self._reload_next_batch(conf)
+
+    @staticmethod
+    def _kill_worker(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
     def _clean_exit(self, *args, **kwargs):
         # Don't need to be called more.
         signal.signal(signal.SIGTERM, signal.SIG_IGN)
@@ -340,43 +2134,199 @@ class ServiceManager(object):
                         reason='Graceful shutdown timeout exceeded, '
                         'instantaneous exiting of master process')
 
-    def _slowdown_respawn_if_needed(self):
-        # Limit ourselves to one process a second (over the period of
-        # number of workers * 1 second). This will allow workers to
-        # start up quickly but ensure we don't fork off children that
-        # die instantly too quickly.
+    def _stop_services(self, confs, last):
+        """Terminate the children of services and wait for them to exit"""
+        remaining = {}
+        for conf in confs:
+            for pid in itertools.chain(self._running_services[conf],
+                                       conf.spare_pids):
+                remaining[pid] = conf
+            if conf.zygote_pid is not None:
+                remaining[conf.zygote_pid] = conf
+        for pid in self._lost_children:
+            remaining.pop(pid, None)
+
+        LOG.debug("Killing services with signal SIGTERM")
+        if last:
+            # NOTE: Also terminates the processes started by the
+            # services
+            os.killpg(0, signal.SIGTERM)
+        else:
+            for pid in remaining:
+                self._kill_worker(pid, signal.SIGTERM)
+        for conf in confs:
+            if conf.shutdown_timeout is not None:
+                self._call_later(conf.shutdown_timeout, functools.partial(
+                    self._kill_stragglers, conf, remaining))
 
-        expected_children = sum(s.workers for s in self._services)
-        if len(self._forktimes) > expected_children:
-            if time.time() - self._forktimes[0] < expected_children:
-                LOG.info('Forking too fast, sleeping')
-                time.sleep(1)
-                self._forktimes.pop(0)
-                self._forktimes.append(time.time())
+        LOG.debug("Waiting services to terminate")
+        # NOTE: Children are reaped as they exit, so the shutdown
+        # lasts as long as the slowest one
+        while remaining:
+            for pid, status in self._reap_children():
+                remaining.pop(pid, None)
+                self._child_stopped(pid, status)
+            while self._lost_children:
+                pid = self._lost_children.pop()
+                remaining.pop(pid, None)
+                self._child_stopped(pid, None)
+            if remaining:
+                self._wait_for_events()
+
+    def _child_stopped(self, pid, status):
+        """Forget a child reaped during the shutdown
+
+        :param status: the exit status, None if it has been reaped by
+                       someone else
+        """
+        self._unwatch_child(pid)
+        conf = self._zygotes.pop(pid, None)
+        if conf is not None:
+            os.close(conf.zygote_fd)
+            conf.zygote_pid = conf.zygote_fd = None
+            return
+        conf = self._spare_pids.pop(pid, None)
+        if conf is not None:
+            conf.spare_pids.discard(pid)
+            conf.spares_ready.discard(pid)
+            return
+        info = self._pids.pop(pid, None)
+        if info is None:
+            return
+        conf, worker_id = info
+        del self._running_services[conf][pid]
+        self._clear_ready(conf, self._get_slot(conf, worker_id))
+        if status is not None:
+            self._run_hooks('worker_exit', conf.service_id, worker_id, pid,
+                            status, _monotonic() -
+                            self._get_slot(conf, worker_id).started_at)
+
+    def _kill_stragglers(self, conf, remaining):
+        for pid in [pid for pid, pid_conf in remaining.items()
+                    if pid_conf is conf]:
+            try:
+                wpid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+                # NOTE: Not our child anymore, nothing to wait for
+                wpid, status = pid, None
+            if wpid:
+                del remaining[pid]
+                self._child_stopped(pid, status)
+                continue
+            LOG.warning('Child %(pid)d of service %(name)s still running '
+                        '%(timeout).1fs after SIGTERM, killing it',
+                        dict(pid=pid, name=self._service_name(conf),
+                             timeout=conf.shutdown_timeout))
+            self._kill_worker(pid, signal.SIGKILL)
+
+    def _dispatch_tasks(self):
+        for conf in self._services.values():
+            if conf.tasks is not None:
+                conf.tasks._dispatch()
 
     def _start_service(self, config, worker_id):
-        self._slowdown_respawn_if_needed()
-
+        if config.tasks is not None:
+            task_read_fd, task_write_fd = os.pipe()
         pid = os.fork()
         if pid != 0:
+            if config.tasks is not None:
+                os.close(task_read_fd)
+                config.tasks._add_worker(pid, task_write_fd)
             return pid
-
+        self._reset_master_state()
+        if config.tasks is not None:
+            os.close(task_write_fd)
+            global _task_fd
+            _task_fd = task_read_fd
+        self._run_service(config, worker_id)
+
+    def _reset_master_state(self):
         # reset parent signals
         signal.signal(signal.SIGINT, signal.SIG_DFL)
         signal.signal(signal.SIGALRM, signal.SIG_DFL)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        if self._epoll:
+            # NOTE: The epoll instance is shared with the master, the fds
+            # must not be unregistered from it
+            self._poller.close()
+            self._epoll = False
+            self._poller = select.poll()
+            for fd in self._fd_handlers:
+                self._poller.register(fd)
+        if self._control is not None:
+            self._control.close(unlink=False)
+        if self._metrics is not None:
+            self._metrics.close(unlink=False)
+        for fd in self._fd_handlers:
+            os.close(fd)
+        os.close(self._signal_pipe_w)
+        for conf in self._services.values():
+            if conf.tasks is not None:
+                conf.tasks._close_fds()
+            if conf.zygote_fd is not None:
+                os.close(conf.zygote_fd)
+            if conf.spare_write_fd is not None:
+                os.close(conf.spare_write_fd)
 
         # Close write to ensure only parent has it open
         os.close(self.writepipe)
 
-        _spawn(self._watch_parent_process)
+        global _status_fd
+        _status_fd = self._status_pipe_w
+
+    @staticmethod
+    def _set_cpu_affinity(config, worker_id):
+        if config.cpu_sets is None or worker_id == _SPARE_WORKER_ID:
+            return
+        cpus = config.cpu_sets[worker_id % len(config.cpu_sets)]
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            LOG.warning('Fail to pin worker %(worker_id)d on CPUs %(cpus)s',
+                        dict(worker_id=worker_id, cpus=sorted(cpus)),
+                        exc_info=True)
+
+    @staticmethod
+    def _setup_listen_sockets(config, worker_id):
+        global _listen_sockets
+        if not config.reuseport:
+            _listen_sockets = config.sockets
+            return
+        with _exit_on_exception():
+            _listen_sockets = []
+            for reserved in config.sockets:
+                # NOTE: the address of the reserved socket, in case
+                # the port was choosen by the kernel
+                sock = _bind_socket(reserved.getsockname()[:2],
+                                    reuseport=True)
+                _listen_sockets.append(sock)
+                # NOTE: spares don't get connections until promoted
+                if worker_id != _SPARE_WORKER_ID:
+                    sock.listen(config.backlog)
+
+    def _run_service(self, config, worker_id):
+        watch_parent = not self._set_parent_death_signal()
+        if watch_parent:
+            _spawn(self._watch_parent_process)
 
         # Reseed random number generator
         random.seed()
 
+        self._setup_listen_sockets(config, worker_id)
+        global _heartbeat_timeout, _stats_slots
+        _heartbeat_timeout = config.heartbeat_timeout
+        _stats_slots = (self._stats_board.buffer, config.stats_first,
+                        config.stats_slots)
+
         # Create and run a new service
         with _exit_on_exception():
+            self._set_cpu_affinity(config, worker_id)
+
             catched_signals = {
                 signal.SIGHUP: None,
                 signal.SIGTERM: None,
@@ -398,16 +2348,34 @@ class ServiceManager(object):
             self._current_process = config.service(worker_id, *args, **kwargs)
 
             # Setup final signals
+            sigterm_handler = (self._current_process._clean_exit
+                               if watch_parent else self._child_sigterm)
             if catched_signals[signal.SIGTERM] is not None:
-                self._current_process._clean_exit(
-                    signal.SIGTERM, catched_signals[signal.SIGTERM])
-            signal.signal(signal.SIGTERM, self._current_process._clean_exit)
+                sigterm_handler(signal.SIGTERM,
+                                catched_signals[signal.SIGTERM])
+            signal.signal(signal.SIGTERM, sigterm_handler)
 
             if catched_signals[signal.SIGHUP] is not None:
                 self._current_process._reload(
                     signal.SIGHUP, catched_signals[signal.SIGHUP])
             signal.signal(signal.SIGHUP, self._current_process._reload)
 
+            _notify_master(_STATUS_STARTED)
+            if worker_id == _SPARE_WORKER_ID:
+                self._wait_promotion(config)
+                if config.reuseport:
+                    for sock in _listen_sockets:
+                        sock.listen(config.backlog)
+            if self._current_process.ready_on_init:
+                _notify_master(_STATUS_READY)
+
+            if (_RUN_IN_MAIN_THREAD and
+                    self._current_process.run_in_main_thread):
+                self._current_process._run()
+                # Wait forever, signal handlers do the rest
+                while True:
+                    signal.pause()
+
             # Start the main thread
             _spawn(self._current_process._run)
 
@@ -418,6 +2386,34 @@ class ServiceManager(object):
         while True:
             time.sleep(100000000)
 
+    def _set_parent_death_signal(self):
+        """Get SIGTERM when the master dies, return False if unsupported"""
+        if (not _RUN_IN_MAIN_THREAD or
+                not _prctl(_PR_SET_PDEATHSIG, signal.SIGTERM)):
+            return False
+        if os.getppid() != self._master_pid:
+            # The master died before prctl()
+            os._exit(0)
+        return True
+
+    def _child_sigterm(self, sig, frame):
+        # NOTE: When the master dies, we are reparented before
+        # receiving the parent death signal
+        if os.getppid() != self._master_pid:
+            self._parent_died()
+        else:
+            self._current_process._clean_exit(sig, frame)
+
+    def _wait_promotion(self, config):
+        data = _read_exactly(config.spare_read_fd, _WORKER_ID.size)
+        if data is None:
+            # The master process is gone
+            os._exit(0)
+        worker_id = _WORKER_ID.unpack(data)[0]
+        self._current_process._set_worker_id(worker_id)
+        self._set_cpu_affinity(config, worker_id)
+        _notify_master(_STATUS_PROMOTED, worker_id)
+
     def _watch_parent_process(self):
         # This will block until the write end is closed when the parent
         # dies unexpectedly
@@ -425,28 +2421,28 @@ class ServiceManager(object):
             os.read(self.readpipe, 1)
         except EnvironmentError:
             pass
+        self._parent_died()
 
+    def _parent_died(self):
         if self._current_process is not None:
             LOG.info('Parent process has died unexpectedly, %s exiting'
                      % self._current_process._title)
             with _exit_on_exception():
-                self._current_process.terminate()
+                self._current_process._terminate()
                 sys.exit(0)
 
         else:
             os._exit(0)
 
-    @staticmethod
-    def _systemd_notify_once():
-        """Send notification once to Systemd that service is ready.
+    def _systemd_notify(self, message):
+        """Send a notification to systemd
 
         Systemd sets NOTIFY_SOCKET environment variable with the name of the
-        socket listening for notifications from services.
-        This method removes the NOTIFY_SOCKET environment variable to ensure
-        notification is sent only once.
+        socket listening for notifications from services. It's removed from
+        the environment when the ServiceManager is created, so children don't
+        inherit it.
         """
-
-        notify_socket = os.getenv('NOTIFY_SOCKET')
+        notify_socket = self._notify_socket
         if notify_socket:
             if notify_socket.startswith('@'):
                 # abstract namespace socket
@@ -455,7 +2451,13 @@ class ServiceManager(object):
             with contextlib.closing(sock):
                 try:
                     sock.connect(notify_socket)
-                    sock.sendall(b'READY=1')
-                    del os.environ['NOTIFY_SOCKET']
+                    sock.sendall(message)
                 except EnvironmentError:
                     LOG.debug("Systemd notification failed", exc_info=True)
+
+from cotyledon import _control  # noqa
+from cotyledon import _metrics  # noqa
+from cotyledon._stats import read_stats, Stats  # noqa
+from cotyledon._tasks import TaskQueue, TaskService  # noqa
+if sys.version_info >= (3, 5):
+    from cotyledon._aio import AsyncService  # noqa
@@ -0,0 +1,193 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+
+import cotyledon
+
+LOG = logging.getLogger("cotyledon")
+
+
+class AsyncService(cotyledon.Service):
+    """Base class for a service running an asyncio event loop
+
+    Like :py:class:`cotyledon.Service`, but :py:meth:`run`,
+    :py:meth:`terminate` and :py:meth:`reload` are coroutines running in
+    an event loop dedicated to the worker. SIGTERM and SIGHUP are handled by
+    the event loop, so these coroutines never run in a signal handler.
+
+    Heartbeats are sent by the event loop, so a blocked event loop is
+    detected when the service is added with a `heartbeat_timeout`.
+
+    On SIGTERM, :py:meth:`terminate` is awaited, then the :py:meth:`run`
+    task is cancelled. Both must complete within
+    :py:attr:`graceful_shutdown_timeout` seconds, otherwise the process
+    exits anyway.
+
+    Requires Python >= 3.5.
+    """
+
+    graceful_shutdown_timeout = 60
+    """Time in seconds given to :py:meth:`terminate` and to the cancellation
+    of :py:meth:`run` before exiting the process."""
+
+    # NOTE: The event loop handles the signals, it must run in the main thread
+    run_in_main_thread = True
+
+    _loop = None
+    _exiting = False
+    _reload_pending = False
+
+    async def run(self):
+        """Coroutine representing the service activity
+
+        If not implemented the process will just wait to receive an ending
+        signal.
+        """
+
+    async def terminate(self):
+        """Coroutine gracefully shutting down the service
+
+        If not implemented the process will just end with status 0.
+
+        To customize the exit code, the :py:class:`SystemExit` exception can be
+        used.
+        """
+
+    async def reload(self):
+        """Coroutine reloading the service
+
+        This coroutine will be executed when the Service receives a SIGHUP.
+
+        If not implemented the process will gracefully exit with status 0 and
+        :py:class:`cotyledon.ServiceManager` will start a new fresh process
+        for this service with the same worker_id.
+        """
+        self._graceful_exit('Caught SIGHUP signal, graceful exiting of '
+                            'service %s' % self._title)
+
+    def _run(self):
+        LOG.debug("Run service %s" % self._title)
+        with cotyledon._exit_on_exception():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            # NOTE: the master process, to detect its death when the
+            # ServiceManager turns it into SIGTERM
+            self._ppid = os.getppid()
+            self._exit_code = self._loop.create_future()
+            self._loop.add_signal_handler(signal.SIGTERM, self._on_sigterm)
+            self._loop.add_signal_handler(signal.SIGHUP, self._on_sighup)
+            if self._reload_pending:
+                self._on_sighup()
+            if cotyledon._heartbeat_timeout is not None:
+                self._heartbeat_tick()
+            self._run_task = self._loop.create_task(self.run())
+            self._run_task.add_done_callback(self._on_run_done)
+            sys.exit(self._loop.run_until_complete(self._exit_code))
+
+    def _heartbeat_tick(self):
+        self.heartbeat()
+        self._loop.call_later(cotyledon._heartbeat_timeout / 4.0,
+                              self._heartbeat_tick)
+
+    def _on_run_done(self, task):
+        if (not task.cancelled() and task.exception() is not None and
+                not self._exit_code.done()):
+            self._exit_code.set_exception(task.exception())
+
+    def _on_sigterm(self):
+        if os.getppid() != self._ppid:
+            self._graceful_exit('Parent process has died unexpectedly, %s '
+                                'exiting' % self._title)
+        else:
+            self._graceful_exit('Caught SIGTERM signal, graceful exiting of '
+                                'service %s' % self._title)
+
+    def _reload(self, sig, frame):
+        # NOTE: Caught before the event loop handles SIGHUP, reload() is
+        # awaited once it runs
+        self._reload_pending = True
+
+    def _on_sighup(self):
+        self._loop.create_task(self._reload_task())
+
+    async def _reload_task(self):
+        try:
+            await self.reload()
+        except BaseException as exc:
+            if not self._exit_code.done():
+                self._exit_code.set_exception(exc)
+            return
+        if not self._exiting:
+            # NOTE: The replacement of an exiting worker reports itself ready
+            cotyledon._notify_master(cotyledon._STATUS_READY)
+
+    def _graceful_exit(self, reason):
+        self._exiting = True
+        self._loop.remove_signal_handler(signal.SIGTERM)
+        LOG.info(reason)
+        self._loop.create_task(self._shutdown())
+
+    async def _shutdown(self):
+        deadline = self._loop.time() + self.graceful_shutdown_timeout
+        code = 0
+        try:
+            code = await asyncio.wait_for(self._terminate_code(),
+                                          self.graceful_shutdown_timeout)
+        except asyncio.TimeoutError:
+            LOG.warning('Graceful shutdown timeout exceeded, %s exiting'
+                        % self._title)
+        except Exception:
+            LOG.exception('Unhandled exception')
+            code = 2
+        if not self._run_task.done():
+            self._run_task.cancel()
+            await asyncio.wait([self._run_task],
+                               timeout=max(0, deadline - self._loop.time()))
+        if not self._exit_code.done():
+            self._exit_code.set_result(code)
+
+    async def _terminate_code(self):
+        # NOTE: SystemExit raised by a task escapes the event loop, so it's
+        # turned into the exit code here
+        try:
+            result = self.terminate()
+            if asyncio.iscoroutine(result):
+                await result
+        except SystemExit as exc:
+            return exc.code
+        return 0
+
+    def _terminate(self):
+        if self._loop is None or not self._loop.is_running():
+            # NOTE: Called during initialisation, before the event
+            # loop runs
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(asyncio.wait_for(
+                    self.terminate(), self.graceful_shutdown_timeout))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                loop.close()
+        else:
+            # NOTE: Called from the parent process watcher thread,
+            # the event loop will exit the process
+            self._loop.call_soon_threadsafe(
+                self._loop.create_task, self._shutdown())
+            while True:
+                time.sleep(100000000)
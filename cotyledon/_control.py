@@ -0,0 +1,355 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import argparse
+import contextlib
+import errno
+import functools
+import json
+import logging
+import numbers
+import os
+import select
+import signal
+import socket
+import sys
+
+import cotyledon
+
+LOG = logging.getLogger("cotyledon")
+
+# Maximum size of a request, one JSON document terminated by a newline
+_MAX_REQUEST_SIZE = 65536
+# Timeout of the clients to send their request and read the response, and
+# of the CLI
+_TIMEOUT = 5
+
+
+def _bind_unix_socket(path, mode=0o600):
+    """Create a non-blocking unix socket listening on path
+
+    A socket file left by a process that has not exited cleanly is replaced.
+
+    :raises: RuntimeError if another process listens on path, socket.error
+    """
+    if not cotyledon._unlink_stale_unix_socket(path):
+        raise RuntimeError("%s is already used by another process" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        os.chmod(path, mode)
+        sock.listen(16)
+        sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class _Client(object):
+    def __init__(self, sock, timer):
+        self.sock = sock
+        # Request received so far, then response left to send
+        self.data = b''
+        self.timer = timer
+
+
+class _SocketServer(object):
+    """Non-blocking request/response server run by the supervision loop
+
+    Each client sends one request and gets back one response, then the
+    connection is closed. Responses are written as the client reads them, so
+    a slow client never blocks the master. Clients are disconnected after
+    _TIMEOUT seconds.
+    """
+
+    max_request_size = _MAX_REQUEST_SIZE
+
+    def __init__(self, manager, sock):
+        self._manager = manager
+        self._sock = sock
+        # fd -> _Client of the connected clients
+        self._clients = {}
+        manager._register_fd(sock.fileno(), self._accept)
+
+    def _get_response(self, request):
+        """Return the response to a request, None if it is incomplete"""
+        raise NotImplementedError
+
+    def close(self):
+        for fd in list(self._clients):
+            self._close_client(fd)
+        self._manager._unregister_fd(self._sock.fileno())
+        self._sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except socket.error as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            fd = sock.fileno()
+            self._clients[fd] = _Client(sock, self._manager._call_later(
+                _TIMEOUT, functools.partial(self._client_timeout, fd, sock)))
+            self._manager._register_fd(fd, functools.partial(self._read, fd))
+
+    def _client_timeout(self, fd, sock):
+        client = self._clients.get(fd)
+        if client is not None and client.sock is sock:
+            client.timer = None
+            self._close_client(fd)
+
+    def _close_client(self, fd):
+        client = self._clients.pop(fd)
+        if client.timer is not None:
+            self._manager._cancel_timer(client.timer)
+        self._manager._unregister_fd(fd)
+        client.sock.close()
+
+    def _read(self, fd):
+        client = self._clients[fd]
+        try:
+            chunk = client.sock.recv(4096)
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            chunk = b''
+        client.data += chunk
+        if not chunk or len(client.data) > self.max_request_size:
+            self._close_client(fd)
+            return
+        response = self._get_response(client.data)
+        if response is None:
+            return
+        client.data = response
+        self._manager._unregister_fd(fd)
+        self._manager._register_fd(fd, functools.partial(self._write, fd),
+                                   select.POLLOUT)
+        self._write(fd)
+
+    def _write(self, fd):
+        client = self._clients[fd]
+        try:
+            sent = client.sock.send(client.data)
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            LOG.debug("Fail to send the response", exc_info=True)
+            self._close_client(fd)
+            return
+        client.data = client.data[sent:]
+        if not client.data:
+            self._close_client(fd)
+
+
+class _ControlServer(_SocketServer):
+    """Unix socket served by the supervision loop of the master
+
+    Each connection sends one JSON request terminated by a newline, like
+    {"command": "scale", "service": "foo", "workers": 4}, and gets back one
+    JSON response, {"result": ...} or {"error": "..."}.
+    """
+
+    def __init__(self, manager, path):
+        self.path = path
+        super(_ControlServer, self).__init__(manager,
+                                             _bind_unix_socket(path))
+
+    def close(self, unlink=True):
+        super(_ControlServer, self).close()
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _get_response(self, request):
+        if b'\n' not in request:
+            return None
+        response = self._handle(request.split(b'\n', 1)[0])
+        return json.dumps(response).encode('utf-8') + b'\n'
+
+    def _handle(self, line):
+        try:
+            request = json.loads(line.decode('utf-8'))
+            command = getattr(self, '_command_%s' % request.pop('command'))
+        except (AttributeError, KeyError, TypeError, ValueError) as exc:
+            return {'error': 'invalid request: %s' % exc}
+        try:
+            return {'result': command(**request)}
+        except TypeError as exc:
+            return {'error': 'invalid request: %s' % exc}
+        except ValueError as exc:
+            return {'error': str(exc)}
+        except Exception as exc:
+            LOG.exception('Unhandled exception in control command')
+            return {'error': str(exc)}
+
+    def _get_services(self, service):
+        confs = [conf for conf in self._manager._services.values()
+                 if service in (self._manager._service_name(conf),
+                                str(conf.service_id))]
+        if not confs:
+            raise ValueError("unknown service %s" % service)
+        return confs
+
+    def _get_pids(self, service, worker_id):
+        pids = []
+        for conf in self._get_services(service):
+            if worker_id is None:
+                pids.extend(self._manager._running_services[conf])
+                continue
+            if (isinstance(worker_id, bool) or
+                    not isinstance(worker_id, numbers.Integral) or
+                    not 0 <= worker_id < conf.workers):
+                raise ValueError("invalid worker %r of %s" %
+                                 (worker_id, service))
+            slot = self._manager._get_slot(conf, worker_id)
+            if slot.pid is None:
+                raise ValueError("worker %d of %s is not running" %
+                                 (worker_id, service))
+            pids.append(slot.pid)
+        return pids
+
+    def _command_status(self):
+        manager = self._manager
+        now = cotyledon._monotonic()
+        services = []
+        for conf in manager._services.values():
+            workers = []
+            for pid, worker_id in sorted(
+                    manager._running_services[conf].items(),
+                    key=lambda item: item[1]):
+                slot = manager._get_slot(conf, worker_id)
+                try:
+                    rss = cotyledon._get_rss(pid)
+                except EnvironmentError:
+                    rss = None
+                workers.append(dict(worker_id=worker_id, pid=pid,
+                                    uptime=now - slot.started_at,
+                                    restarts=slot.restarts,
+                                    ready=slot.ready_at is not None,
+                                    rss=rss))
+            services.append(dict(service=manager._service_name(conf),
+                                 service_id=str(conf.service_id),
+                                 workers=conf.workers,
+                                 degraded=conf.degraded,
+                                 running=workers))
+        return services
+
+    def _command_reload(self, service=None, worker_id=None):
+        if service is None:
+            self._manager._reload_services()
+        elif worker_id is None:
+            for conf in self._get_services(service):
+                self._manager._reload_service(conf)
+        else:
+            for pid in self._get_pids(service, worker_id):
+                self._manager._kill_worker(pid, signal.SIGHUP)
+
+    def _command_restart(self, service, worker_id=None):
+        for pid in self._get_pids(service, worker_id):
+            self._manager._kill_worker(pid, signal.SIGTERM)
+
+    def _command_scale(self, service, workers):
+        for conf in self._get_services(service):
+            self._manager.reconfigure(conf.service_id, workers)
+
+
+def send_command(path, command, **kwargs):
+    """Send a command to the control socket of a ServiceManager
+
+    :param path: path of the control socket
+    :param command: status, reload, restart or scale
+    :return: the result of the command
+    :raises: RuntimeError, socket.error, ValueError if the response is
+             missing or truncated
+    """
+    kwargs['command'] = command
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with contextlib.closing(sock):
+        sock.settimeout(_TIMEOUT)
+        sock.connect(path)
+        sock.sendall(json.dumps(kwargs).encode('utf-8') + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    response = json.loads(data.decode('utf-8'))
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+
+def _print_status(services):
+    print("%-20s %6s %8s %10s %8s %10s %s" % (
+        "SERVICE", "WORKER", "PID", "UPTIME", "RESTARTS", "RSS", "READY"))
+    for service in services:
+        name = service['service']
+        if service['degraded']:
+            name += " (degraded)"
+        for worker in service['running']:
+            rss = ("-" if worker['rss'] is None
+                   else "%dM" % (worker['rss'] // (1024 * 1024)))
+            print("%-20s %6d %8d %9ds %8d %10s %s" % (
+                name, worker['worker_id'], worker['pid'], worker['uptime'],
+                worker['restarts'], rss, "yes" if worker['ready'] else "no"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cotyledon-ctl",
+        description="Control a ServiceManager through its control socket")
+    parser.add_argument("socket", help="path of the control socket")
+    parser.add_argument("--json", action="store_true",
+                        help="print the raw JSON result")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+    subparsers.add_parser("status", help="show the running workers")
+    for command, help in (("reload", "reload services or a worker"),
+                          ("restart", "restart a service or a worker")):
+        subparser = subparsers.add_parser(command, help=help)
+        subparser.add_argument("service", nargs=None if command == "restart"
+                               else "?", help="name or id of the service")
+        subparser.add_argument("worker_id", nargs="?", type=int)
+    subparser = subparsers.add_parser("scale",
+                                      help="change the number of workers")
+    subparser.add_argument("service", help="name or id of the service")
+    subparser.add_argument("workers", type=int)
+    args = vars(parser.parse_args(argv))
+
+    path = args.pop("socket")
+    as_json = args.pop("json")
+    command = args.pop("command")
+    kwargs = dict((key, value) for key, value in args.items()
+                  if value is not None)
+    try:
+        result = send_command(path, command, **kwargs)
+    except (RuntimeError, socket.error) as exc:
+        sys.stderr.write("%s: %s\n" % (parser.prog, exc))
+        return 1
+    except ValueError:
+        sys.stderr.write("%s: invalid response from %s\n" %
+                         (parser.prog, path))
+        return 1
+    if as_json:
+        print(json.dumps(result, indent=2))
+    elif command == "status":
+        _print_status(result)
+    return 0
@@ -0,0 +1,268 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import socket
+
+import cotyledon
+from cotyledon import _control
+
+LOG = logging.getLogger("cotyledon")
+
+# Samples of the workers are reused during this time in seconds, so the
+# master reads /proc at most once per period whatever the number of scrapers
+_CACHE_TTL = 5
+# Interval of the rewrites of the textfile in seconds
+_TEXTFILE_INTERVAL = 15
+# Maximum size of an HTTP request
+_MAX_REQUEST_SIZE = 8192
+
+_OPENMETRICS_CONTENT_TYPE = ("application/openmetrics-text; version=1.0.0; "
+                             "charset=utf-8")
+_TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                  for key in sorted(labels))
+    return '%s %s\n' % (name, repr(float(value)))
+
+
+def _render(families, openmetrics=True):
+    """Render metric families in the OpenMetrics or Prometheus text format
+
+    :param families: list of (name, type, help, samples) where samples is a
+                     list of (labels dict, value)
+    :param openmetrics: use the OpenMetrics format, otherwise the Prometheus
+                        text format read by the node_exporter
+    """
+    lines = []
+    for name, kind, help, samples in families:
+        sample_name = name + '_total' if kind == 'counter' else name
+        if not openmetrics:
+            name = sample_name
+            if kind == 'unknown':
+                kind = 'untyped'
+        lines.append('# HELP %s %s\n' % (name, help))
+        lines.append('# TYPE %s %s\n' % (name, kind))
+        for labels, value in samples:
+            lines.append(_format_sample(sample_name, labels, value))
+    if openmetrics:
+        lines.append('# EOF\n')
+    return ''.join(lines).encode('utf-8')
+
+
+class _MetricsServer(_control._SocketServer):
+    """HTTP server of the metrics"""
+
+    max_request_size = _MAX_REQUEST_SIZE
+
+    def __init__(self, manager, sock, exporter):
+        self._exporter = exporter
+        super(_MetricsServer, self).__init__(manager, sock)
+
+    def _get_response(self, request):
+        if b'\r\n\r\n' not in request and b'\n\n' not in request:
+            return None
+        return self._exporter._handle(request)
+
+
+class _MetricsExporter(object):
+    """Metrics of the supervision tree served by the master
+
+    The metrics are served over HTTP on a TCP or unix socket by the
+    supervision loop of the master, and/or written periodically into a file
+    for the textfile collector of the node_exporter.
+    """
+
+    def __init__(self, manager, address=None, textfile=None):
+        self._manager = manager
+        self.textfile = textfile
+        # (time, families) of the last sampling
+        self._cache = None
+        self._server = None
+        if address is not None:
+            self._server = _MetricsServer(manager, self._bind(address), self)
+
+    def start(self):
+        if self.textfile is not None:
+            self._write_textfile()
+
+    @staticmethod
+    def _bind(address):
+        if not isinstance(address, tuple):
+            return _control._bind_unix_socket(address, 0o666)
+        sock = cotyledon._bind_socket(address)
+        try:
+            sock.listen(16)
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def close(self, unlink=True):
+        if self._server is not None:
+            sock = self._server._sock
+            if unlink and sock.family == socket.AF_UNIX:
+                self._unlink(sock.getsockname())
+            self._server.close()
+            self._server = None
+        if unlink and self.textfile is not None:
+            # NOTE: The node_exporter would keep exposing the last
+            # values of a stopped application
+            self._unlink(self.textfile)
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _get_families(self):
+        now = cotyledon._monotonic()
+        if self._cache is None or now - self._cache[0] >= _CACHE_TTL:
+            self._cache = (now, self._collect(now))
+        return self._cache[1]
+
+    def _collect(self, now):
+        manager = self._manager
+        desired, running, ready, degraded, spares = [], [], [], [], []
+        exits, restarts, failures, backoff, up = [], [], [], [], []
+        uptime, cpu, rss = [], [], []
+        for conf in manager._services.values():
+            service = manager._service_name(conf)
+            labels = dict(service=service)
+            pids = manager._running_services[conf]
+            desired.append((labels, conf.workers))
+            running.append((labels, len(pids)))
+            ready.append((labels, sum(
+                1 for worker_id in pids.values()
+                if manager._get_slot(conf, worker_id).ready_at is not None)))
+            degraded.append((labels, int(conf.degraded)))
+            spares.append((labels, len(conf.spare_pids)))
+            for reason, count in sorted(conf.exits.items()):
+                exits.append((dict(service=service, reason=reason), count))
+
+            pid_by_worker_id = dict((worker_id, pid)
+                                    for pid, worker_id in pids.items())
+            worker_ids = sorted(set(range(conf.workers)) |
+                                set(pid_by_worker_id))
+            for worker_id in worker_ids:
+                slot = manager._get_slot(conf, worker_id)
+                labels = dict(service=service, worker_id=worker_id)
+                restarts.append((labels, slot.restarts))
+                failures.append((labels, slot.failures))
+                backoff.append((labels, int(slot.respawn_timer is not None)))
+                pid = pid_by_worker_id.get(worker_id)
+                up.append((labels, int(pid is not None)))
+                if pid is None:
+                    continue
+                uptime.append((labels, now - slot.started_at))
+                try:
+                    cpu.append((labels, cotyledon._get_cpu_time(pid)))
+                    rss.append((labels, cotyledon._get_rss(pid)))
+                except EnvironmentError:
+                    # NOTE: The worker has just exited
+                    pass
+
+        stats = []
+        for service, values in sorted(manager.stats().items()):
+            for name, value in sorted(values.items()):
+                stats.append((dict(service=service, stat=name), value))
+
+        return [
+            ('cotyledon_service_workers_desired', 'gauge',
+             'Number of workers configured for the service', desired),
+            ('cotyledon_service_workers_running', 'gauge',
+             'Number of running workers of the service', running),
+            ('cotyledon_service_workers_ready', 'gauge',
+             'Number of running workers of the service that are ready',
+             ready),
+            ('cotyledon_service_spares', 'gauge',
+             'Number of pre-forked spare workers of the service', spares),
+            ('cotyledon_service_degraded', 'gauge',
+             'Whether the service is crash looping', degraded),
+            ('cotyledon_service_worker_exits', 'counter',
+             'Deaths of the workers of the service by exit code or signal',
+             exits),
+            ('cotyledon_worker_restarts', 'counter',
+             'Number of restarts of the worker', restarts),
+            ('cotyledon_worker_respawn_failures', 'gauge',
+             'Consecutive early deaths of the worker driving the respawn '
+             'backoff', failures),
+            ('cotyledon_worker_respawn_pending', 'gauge',
+             'Whether the respawn of the worker is delayed by the backoff',
+             backoff),
+            ('cotyledon_worker_up', 'gauge',
+             'Whether the worker is running', up),
+            ('cotyledon_worker_uptime_seconds', 'gauge',
+             'Time since the fork of the worker', uptime),
+            ('cotyledon_worker_cpu_seconds', 'counter',
+             'User and system CPU time of the worker process', cpu),
+            ('cotyledon_worker_resident_memory_bytes', 'gauge',
+             'Resident memory of the worker process', rss),
+            ('cotyledon_service_stat', 'unknown',
+             'Stats of the workers summed by service', stats),
+        ]
+
+    def _write_textfile(self):
+        tmp = "%s.%d.tmp" % (self.textfile, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(_render(self._get_families(), openmetrics=False))
+            os.rename(tmp, self.textfile)
+        except EnvironmentError:
+            LOG.warning("Fail to write the metrics into %s", self.textfile,
+                        exc_info=True)
+            self._unlink(tmp)
+        self._manager._call_later(_TEXTFILE_INTERVAL, self._write_textfile)
+
+    def _handle(self, request):
+        lines = request.decode('latin-1').splitlines()
+        try:
+            method, path = lines[0].split()[:2]
+        except ValueError:
+            return self._response("400 Bad Request")
+        if method not in ("GET", "HEAD"):
+            return self._response("405 Method Not Allowed")
+        if path.split('?', 1)[0] not in ("/", "/metrics"):
+            return self._response("404 Not Found")
+        openmetrics = any(
+            line.lower().startswith("accept:") and
+            "application/openmetrics-text" in line for line in lines[1:])
+        try:
+            body = _render(self._get_families(), openmetrics)
+        except Exception:
+            LOG.exception('Unhandled exception while collecting metrics')
+            return self._response("500 Internal Server Error")
+        return self._response(
+            "200 OK", body, _OPENMETRICS_CONTENT_TYPE if openmetrics
+            else _TEXT_CONTENT_TYPE, head=method == "HEAD")
+
+    @staticmethod
+    def _response(status, body=None, content_type="text/plain",
+                  head=False):
+        if body is None:
+            body = (status + "\n").encode('utf-8')
+        headers = ("HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n"
+                   "Connection: close\r\n\r\n" % (status, content_type,
+                                                  len(body)))
+        return headers.encode('utf-8') + (b'' if head else body)
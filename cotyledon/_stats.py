@@ -0,0 +1,198 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mmap
+import os
+import struct
+
+# Layout of the stats board: a header followed by one fixed-size slot per
+# worker_id. Each slot starts with the pid and worker_id of the worker, the
+# name of its service, its last heartbeat and its number of processed
+# tasks, followed by the names of its
+# stats and then their values. Only the worker writes the names and values
+# of its slot, names are written after their value is initialised, so
+# readers never need any lock.
+_MAGIC = b"COTYSTAT"
+_HEADER = struct.Struct("<8sII")
+_SLOT_HEADER = struct.Struct("<ii64sdd")
+_NAME = struct.Struct("<32s")
+_VALUE = struct.Struct("<d")
+# Maximum number of stats per worker
+MAX_STATS = 16
+_HEARTBEAT_OFFSET = struct.calcsize("<ii64s")
+_TASKS_OFFSET = _HEARTBEAT_OFFSET + _VALUE.size
+_SLOT_SIZE = _SLOT_HEADER.size + MAX_STATS * (_NAME.size + _VALUE.size)
+_NAMES_OFFSET = _SLOT_HEADER.size
+_VALUES_OFFSET = _NAMES_OFFSET + MAX_STATS * _NAME.size
+
+
+class _StatsBoard(object):
+    """Shared memory holding the stats of all workers
+
+    Created by the master before forking the workers, optionally backed by
+    a file so external tools can read it with :py:func:`read_stats`.
+    """
+
+    def __init__(self, slots, path=None):
+        self.slots = slots
+        size = _HEADER.size + slots * _SLOT_SIZE
+        if path is None:
+            self.buffer = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                self.buffer = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        _HEADER.pack_into(self.buffer, 0, _MAGIC, slots, _SLOT_SIZE)
+
+    def assign(self, index, pid, worker_id, name):
+        _SLOT_HEADER.pack_into(self.buffer, _slot_offset(index), pid,
+                               worker_id, name.encode('utf-8')[:64], 0, 0)
+
+    def get_heartbeat(self, index):
+        return _VALUE.unpack_from(self.buffer, _slot_offset(index) +
+                                  _HEARTBEAT_OFFSET)[0]
+
+    def get_tasks(self, index):
+        return _VALUE.unpack_from(self.buffer, _slot_offset(index) +
+                                  _TASKS_OFFSET)[0]
+
+    def get_stats(self, index):
+        return _read_slot(self.buffer, index)[3]
+
+
+class Stats(object):
+    """Counters and gauges of a worker
+
+    Available with :py:attr:`Service.worker_stats`, values are written into
+    memory shared with the master process without any system call or lock.
+    The values of a worker_id are kept when its process is restarted.
+
+    Up to 16 stats can be used by each worker, names are truncated to 32
+    bytes.
+    """
+
+    def __init__(self, buffer, index):
+        self._buffer = buffer
+        self._offset = _slot_offset(index)
+        # name -> offset of the value
+        self._offsets = {}
+        for i in range(MAX_STATS):
+            name = _NAME.unpack_from(buffer, self._offset + _NAMES_OFFSET +
+                                     i * _NAME.size)[0].rstrip(b'\0')
+            if name:
+                self._offsets[name.decode('utf-8')] = (
+                    self._offset + _VALUES_OFFSET + i * _VALUE.size)
+
+    def _value_offset(self, name):
+        offset = self._offsets.get(name)
+        if offset is None:
+            i = len(self._offsets)
+            if i >= MAX_STATS:
+                raise ValueError("too many stats, %s can't be added" % name)
+            offset = self._offset + _VALUES_OFFSET + i * _VALUE.size
+            _VALUE.pack_into(self._buffer, offset, 0)
+            _NAME.pack_into(self._buffer, self._offset + _NAMES_OFFSET +
+                            i * _NAME.size, name.encode('utf-8')[:32])
+            self._offsets[name] = offset
+        return offset
+
+    def _set_heartbeat(self, now):
+        _VALUE.pack_into(self._buffer, self._offset + _HEARTBEAT_OFFSET, now)
+
+    def _add_tasks(self, count):
+        offset = self._offset + _TASKS_OFFSET
+        _VALUE.pack_into(self._buffer, offset,
+                         _VALUE.unpack_from(self._buffer, offset)[0] + count)
+
+    def incr(self, name, value=1):
+        """Increment a counter
+
+        :param name: name of the counter
+        :type name: str
+        :param value: value to add to the counter
+        :type value: float
+        """
+        offset = self._value_offset(name)
+        _VALUE.pack_into(self._buffer, offset,
+                         _VALUE.unpack_from(self._buffer, offset)[0] + value)
+
+    def set(self, name, value):
+        """Set a gauge
+
+        :param name: name of the gauge
+        :type name: str
+        :param value: value of the gauge
+        :type value: float
+        """
+        _VALUE.pack_into(self._buffer, self._value_offset(name), value)
+
+    def get(self, name):
+        """Return the value of a stat, 0 if it has never been set
+
+        :param name: name of the stat
+        :type name: str
+        """
+        if name not in self._offsets:
+            return 0
+        return _VALUE.unpack_from(self._buffer,
+                                  self._value_offset(name))[0]
+
+
+def _slot_offset(index):
+    return _HEADER.size + index * _SLOT_SIZE
+
+
+def _read_slot(buffer, index):
+    offset = _slot_offset(index)
+    pid, worker_id, name, _, _ = _SLOT_HEADER.unpack_from(buffer, offset)
+    stats = {}
+    for i in range(MAX_STATS):
+        stat = _NAME.unpack_from(buffer, offset + _NAMES_OFFSET +
+                                 i * _NAME.size)[0].rstrip(b'\0')
+        if not stat:
+            break
+        stats[stat.decode('utf-8')] = _VALUE.unpack_from(
+            buffer, offset + _VALUES_OFFSET + i * _VALUE.size)[0]
+    return pid, worker_id, name.rstrip(b'\0').decode('utf-8'), stats
+
+
+def read_stats(path):
+    """Read the stats of the workers from a stats file
+
+    The file is written by a :py:class:`ServiceManager` created with
+    `stats_path`, it can be read from any process.
+
+    :param path: path of the stats file
+    :type path: str
+    :return: a list of dict with the service name, worker_id, pid (0 if the
+             worker is not running) and stats of each worker that has been
+             started at least once
+    :raises: ValueError, EnvironmentError
+    """
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    if len(buffer) < _HEADER.size:
+        raise ValueError("%s is not a stats file" % path)
+    magic, slots, slot_size = _HEADER.unpack_from(buffer)
+    if (magic != _MAGIC or slot_size != _SLOT_SIZE or
+            len(buffer) < _slot_offset(slots)):
+        raise ValueError("%s is not a stats file" % path)
+    workers = []
+    for index in range(slots):
+        pid, worker_id, name, stats = _read_slot(buffer, index)
+        if name:
+            workers.append(dict(service=name, worker_id=worker_id, pid=pid,
+                                stats=stats))
+    return workers
@@ -0,0 +1,305 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import errno
+import functools
+import logging
+import os
+import pickle
+import select
+import struct
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cotyledon
+
+LOG = logging.getLogger("cotyledon")
+
+# A batch of tasks is sent to a worker as the number of tasks followed by
+# each pickled task prefixed by its size
+_TASK_SIZE = struct.Struct("!I")
+
+
+class _TaskWorker(object):
+    def __init__(self, fd):
+        self.fd = fd
+        # Tasks sent to the worker and not acknowledged yet, in sending
+        # order, as [pickled task, attempts] entries
+        self.inflight = collections.deque()
+        # Part of the last batch not yet written into the pipe
+        self.buffer = b''
+        self.writing = False
+
+
+class TaskQueue(object):
+    """Queue of tasks dispatched by the master to the workers of a service
+
+    Tasks are put into the queue from the master process, usually from a
+    thread or a hook, and are sent to the least loaded worker of the
+    :py:class:`TaskService` added with this queue. Each worker gets at most
+    `max_inflight` tasks not yet processed, so a slow or stuck worker doesn't
+    get more work.
+
+    Tasks still in flight when a worker dies are put back at the front of
+    the queue and processed by another worker, so a task can be processed
+    more than once. Tasks still in the queue when the
+    :py:class:`ServiceManager` shuts down are lost.
+    """
+
+    def __init__(self, maxsize=0, batch_size=1, max_inflight=None,
+                 max_retries=3):
+        """Creates the TaskQueue object
+
+        :param maxsize: maximum number of tasks waiting to be dispatched,
+                        :py:meth:`put` blocks once reached, unlimited if 0
+        :type maxsize: int
+        :param batch_size: maximum number of tasks sent at once to a worker
+        :type batch_size: int
+        :param max_inflight: maximum number of tasks sent to a worker and not
+                             processed yet, twice `batch_size` by default
+        :type max_inflight: int
+        :param max_retries: number of times a task is requeued after the death
+                            of the worker processing it before being dropped
+        :type max_retries: int
+        :raises: ValueError
+        """
+        if max_inflight is None:
+            max_inflight = 2 * batch_size
+        if maxsize < 0:
+            raise ValueError("maxsize must be positive")
+        if batch_size < 1:
+            raise ValueError("batch_size must be greater than 0")
+        if max_inflight < batch_size:
+            raise ValueError("max_inflight must be greater than or equal to "
+                             "batch_size")
+        if max_retries < 0:
+            raise ValueError("max_retries must be positive")
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        # pid -> _TaskWorker of the running workers
+        self._workers = collections.OrderedDict()
+        self._manager = None
+
+    def put(self, item, block=True, timeout=None):
+        """Put a task into the queue
+
+        The task is pickled right away, it must not be modified afterward.
+
+        It must not block from the thread running
+        :py:meth:`ServiceManager.run`, as tasks are dispatched by this thread.
+
+        :param item: the task, a picklable object
+        :param block: wait for a free slot if the queue is full, otherwise
+                      raise :py:class:`queue.Full`
+        :type block: bool
+        :param timeout: maximum time to wait for a free slot in seconds
+        :type timeout: float
+        :raises: queue.Full
+        """
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        with self._cond:
+            if self.maxsize > 0 and len(self._pending) >= self.maxsize:
+                if not block:
+                    raise queue.Full
+                deadline = (None if timeout is None
+                            else cotyledon._monotonic() + timeout)
+                while len(self._pending) >= self.maxsize:
+                    if deadline is None:
+                        self._cond.wait()
+                        continue
+                    remaining = deadline - cotyledon._monotonic()
+                    if remaining <= 0:
+                        raise queue.Full
+                    self._cond.wait(remaining)
+            self._pending.append([data, 0])
+        if self._manager is not None:
+            self._manager._wakeup()
+
+    def qsize(self):
+        """Return the number of tasks waiting to be dispatched"""
+        with self._cond:
+            return len(self._pending)
+
+    def inflight(self):
+        """Return the number of tasks sent to the workers not processed yet"""
+        return sum(len(worker.inflight) for worker in self._workers.values())
+
+    def _attach(self, manager):
+        if self._manager is not None:
+            raise ValueError("a TaskQueue can be used by only one service")
+        self._manager = manager
+
+    def _add_worker(self, pid, fd):
+        cotyledon._set_nonblocking(fd)
+        self._workers[pid] = _TaskWorker(fd)
+
+    def _remove_worker(self, pid):
+        worker = self._workers.pop(pid, None)
+        if worker is None:
+            return
+        if worker.writing:
+            self._manager._unregister_fd(worker.fd)
+        os.close(worker.fd)
+        requeued = []
+        for entry in worker.inflight:
+            entry[1] += 1
+            if entry[1] > self.max_retries:
+                LOG.error('Dropping a task after %d attempts', entry[1])
+            else:
+                requeued.append(entry)
+        if requeued:
+            LOG.info('Requeuing %(count)d tasks of child %(pid)d',
+                     dict(count=len(requeued), pid=pid))
+            with self._cond:
+                self._pending.extendleft(reversed(requeued))
+
+    def _close_fds(self):
+        # NOTE: In a new child, the pipes of the other workers belong
+        # to the master
+        for worker in self._workers.values():
+            if not worker.writing:
+                os.close(worker.fd)
+        self._workers.clear()
+
+    def _task_done(self, pid, count):
+        worker = self._workers.get(pid)
+        if worker is None:
+            return
+        for i in range(min(count, len(worker.inflight))):
+            worker.inflight.popleft()
+
+    def _dispatch(self):
+        with self._cond:
+            dispatched = False
+            while self._pending:
+                available = [worker for worker in self._workers.values()
+                             if not worker.buffer and
+                             len(worker.inflight) < self.max_inflight]
+                if not available:
+                    break
+                worker = min(available,
+                             key=lambda worker: len(worker.inflight))
+                count = min(self.batch_size, len(self._pending),
+                            self.max_inflight - len(worker.inflight))
+                batch = [self._pending.popleft() for i in range(count)]
+                worker.inflight.extend(batch)
+                worker.buffer = _TASK_SIZE.pack(count) + b''.join(
+                    _TASK_SIZE.pack(len(data)) + data for data, _ in batch)
+                self._flush(worker)
+                dispatched = True
+            if dispatched:
+                self._cond.notify_all()
+
+    def _flush(self, worker):
+        try:
+            written = os.write(worker.fd, worker.buffer)
+        except OSError as exc:
+            if exc.errno in (errno.EAGAIN, errno.EINTR):
+                written = 0
+            elif exc.errno == errno.EPIPE:
+                # NOTE: The worker is dying, its tasks will be
+                # requeued once reaped
+                written = len(worker.buffer)
+            else:
+                raise
+        worker.buffer = worker.buffer[written:]
+        if worker.buffer and not worker.writing:
+            worker.writing = True
+            self._manager._register_fd(
+                worker.fd, functools.partial(self._flush, worker),
+                select.POLLOUT)
+        elif not worker.buffer and worker.writing:
+            worker.writing = False
+            self._manager._unregister_fd(worker.fd)
+
+
+class TaskService(cotyledon.Service):
+    """Base class for a service processing tasks of a :py:class:`TaskQueue`
+
+    The service must be added to the :py:class:`ServiceManager` with a
+    :py:class:`TaskQueue`. :py:meth:`run` is already implemented, it
+    processes the tasks until the service is terminated and sends the
+    heartbeats while waiting for tasks and after each batch.
+    """
+
+    def process(self, item):
+        """Method processing a task
+
+        :param item: the task put into the :py:class:`TaskQueue`
+        """
+        raise NotImplementedError
+
+    def process_batch(self, items):
+        """Method processing a batch of tasks
+
+        By default :py:meth:`process` is called for each task.
+
+        :param items: the tasks
+        :type items: list
+        """
+        for item in items:
+            self.process(item)
+
+    def run(self):
+        fd = cotyledon._task_fd
+        if fd is None:
+            raise RuntimeError("%s must be added with a TaskQueue" %
+                               self.name)
+        while True:
+            self._wait_tasks(fd)
+            items = self._read_batch(fd)
+            if items is None:
+                return
+            self.process_batch(items)
+            cotyledon._notify_master(cotyledon._STATUS_TASK_DONE, len(items))
+            self.task_done(len(items))
+            if cotyledon._heartbeat_timeout is not None:
+                self.heartbeat()
+
+    def _wait_tasks(self, fd):
+        timeout = cotyledon._heartbeat_timeout
+        if timeout is None:
+            return
+        while True:
+            self.heartbeat()
+            try:
+                if select.select([fd], [], [], timeout / 4.0)[0]:
+                    return
+            except (select.error, OSError) as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+
+    @staticmethod
+    def _read_batch(fd):
+        """Read a batch of tasks, return None on EOF"""
+        data = cotyledon._read_exactly(fd, _TASK_SIZE.size)
+        if data is None:
+            return None
+        items = []
+        for i in range(_TASK_SIZE.unpack(data)[0]):
+            data = cotyledon._read_exactly(fd, _TASK_SIZE.size)
+            if data is None:
+                return None
+            data = cotyledon._read_exactly(fd, _TASK_SIZE.unpack(data)[0])
+            if data is None:
+                return None
+            items.append(pickle.loads(data))
+        return items
@@ -0,0 +1,236 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Benchmarks of the lifecycle of the workers
+
+Run with:
+
+    python -m cotyledon.tests.benchmarks --workers 10,100,1000 -o out.json
+
+For each number of workers, an application is started in a subprocess. Its
+hooks write the lifecycle events of the workers, timestamped by the master,
+on its stdout. The results are written as JSON.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pbr.version
+
+import cotyledon
+
+_TIMEOUT = 300
+
+
+class IdleService(cotyledon.Service):
+    name = "idle"
+
+    def __init__(self, worker_id):
+        super(IdleService, self).__init__(worker_id)
+        self._shutdown = threading.Event()
+
+    def run(self):
+        self._shutdown.wait()
+
+    def terminate(self):
+        self._shutdown.set()
+
+
+def _event_hook(event):
+    def hook(*args):
+        # NOTE: The worker hooks get the pid as third argument
+        pid = args[2] if args else 0
+        sys.stdout.write("%s %d %.9f\n" % (
+            event, pid, cotyledon._monotonic()))
+        sys.stdout.flush()
+    return hook
+
+
+def benchmark_app(workers):
+    logging.basicConfig(level=logging.WARNING)
+    p = cotyledon.ServiceManager()
+    p.add(IdleService, workers)
+    p.register_hooks(on_fork=_event_hook("fork"),
+                     on_worker_ready=_event_hook("ready"),
+                     on_worker_exit=_event_hook("exit"),
+                     on_reload=_event_hook("reload"))
+    p.run()
+
+
+class _EventReader(object):
+    """Read the events written by the hooks of the application"""
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._buffer = b""
+
+    def read(self):
+        """Return the next (event, pid, timestamp)"""
+        deadline = time.time() + _TIMEOUT
+        while b"\n" not in self._buffer:
+            if not select.select([self._fd], [], [],
+                                 max(0, deadline - time.time()))[0]:
+                raise RuntimeError("Timeout waiting for the workers")
+            data = os.read(self._fd, 4096)
+            if not data:
+                raise RuntimeError("The application has exited")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        event, pid, timestamp = line.split()
+        return event.decode(), int(pid), float(timestamp)
+
+    def read_until(self, event, count=1):
+        """Return the events read until count events of this kind"""
+        events = []
+        while count:
+            events.append(self.read())
+            if events[-1][0] == event:
+                count -= 1
+        return events
+
+
+def _get_timestamp(events, event, pid=0):
+    for name, event_pid, timestamp in events:
+        if name == event and event_pid == pid:
+            return timestamp
+
+
+def _get_cpu_time(pid):
+    try:
+        return cotyledon._get_cpu_time(pid)
+    except EnvironmentError:
+        return None
+
+
+def _get_memory_usage(pid, kind):
+    try:
+        return cotyledon._get_memory_usage(pid)[kind]
+    except EnvironmentError:
+        return None
+
+
+def _average(values):
+    values = [value for value in values if value is not None]
+    return sum(values) / float(len(values)) if values else None
+
+
+def _median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def run_benchmark(workers, respawns=5, idle_duration=2):
+    """Measure the lifecycle of an application with this number of workers
+
+    :return: a dict of the measurements in seconds, CPU fraction and bytes
+    """
+    result = dict(workers=workers)
+    started_at = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "cotyledon.tests.benchmarks", "--app",
+         "--workers", str(workers)],
+        stdout=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+    events = _EventReader(proc.stdout.fileno())
+    try:
+        running = [pid for event, pid, timestamp
+                   in events.read_until("ready", workers)
+                   if event == "ready"]
+        result["startup"] = time.time() - started_at
+
+        cpu_time = _get_cpu_time(proc.pid)
+        time.sleep(idle_duration)
+        if cpu_time is not None:
+            result["idle_master_cpu"] = (
+                (_get_cpu_time(proc.pid) - cpu_time) / idle_duration)
+
+        result["worker_rss"] = _average(_get_memory_usage(pid, "rss")
+                                        for pid in running)
+        result["worker_private"] = _average(
+            _get_memory_usage(pid, "private") for pid in running)
+
+        # NOTE: From the reaping of the killed worker by the master
+        # to the fork and the readiness of its replacement
+        fork_latencies = []
+        latencies = []
+        for i in range(respawns):
+            pid = running.pop(0)
+            os.kill(pid, signal.SIGKILL)
+            respawn = events.read_until("ready")
+            new_pid = respawn[-1][1]
+            exited_at = _get_timestamp(respawn, "exit", pid)
+            fork_latencies.append(
+                _get_timestamp(respawn, "fork", new_pid) - exited_at)
+            latencies.append(respawn[-1][2] - exited_at)
+            running.append(new_pid)
+        result["respawn_fork_latency"] = _median(fork_latencies)
+        result["respawn_latency"] = _median(latencies)
+
+        os.kill(proc.pid, signal.SIGHUP)
+        reload_events = events.read_until("ready", workers)
+        result["reload"] = (reload_events[-1][2] -
+                            _get_timestamp(reload_events, "reload"))
+
+        stopped_at = time.time()
+        proc.terminate()
+        proc.wait()
+        result["shutdown"] = time.time() - stopped_at
+    finally:
+        if proc.poll() is None:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        proc.stdout.close()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the lifecycle of cotyledon workers")
+    parser.add_argument("--workers", default="10,100,500",
+                        help="comma separated numbers of workers")
+    parser.add_argument("--respawns", type=int, default=5,
+                        help="number of workers killed to measure the "
+                        "respawn latency")
+    parser.add_argument("-o", "--output", help="write the results into "
+                        "this file instead of stdout")
+    parser.add_argument("--app", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.app:
+        benchmark_app(int(args.workers))
+        return
+
+    results = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpu_count=os.sysconf('SC_NPROCESSORS_ONLN'),
+        cotyledon=pbr.version.VersionInfo('cotyledon').version_string(),
+        results=[run_benchmark(int(workers), args.respawns)
+                 for workers in args.workers.split(",")],
+    )
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
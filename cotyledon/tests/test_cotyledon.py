@@ -12,12 +12,37 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import os
+import pickle
 import re
+import resource
+import select
 import signal
+import socket
+import struct
 import subprocess
+import sys
+import threading
 import time
 
+import fixtures
+import testtools
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import cotyledon
+from cotyledon import _control
+from cotyledon import _metrics
+from cotyledon import _stats
 from cotyledon.tests import base
 
 
@@ -190,3 +215,1330 @@ class TestCotyledon(base.TestCase):
             b'light(0) [XXXX] exiting',
         ], lines)
         self.assert_everything_is_dead(-9)
+
+
+class TestWorkerSlot(base.TestCase):
+    EXIT_0 = 0
+    EXIT_1 = 1 << 8
+    SIGKILLED = signal.SIGKILL
+
+    def test_clean_exit_respawn_immediately(self):
+        slot = cotyledon._WorkerSlot()
+        slot.started_at = 0
+        for i in range(10):
+            self.assertEqual(0, slot.next_respawn_delay(1, self.EXIT_0))
+        self.assertEqual(0, slot.failures)
+
+    def test_crash_backoff(self):
+        slot = cotyledon._WorkerSlot()
+        slot.started_at = 0
+        self.assertEqual(0, slot.next_respawn_delay(1, self.EXIT_1))
+        delays = [slot.next_respawn_delay(1, self.SIGKILLED)
+                  for i in range(10)]
+        for i, delay in enumerate(delays):
+            expected = min(cotyledon._RESPAWN_BACKOFF_MAX,
+                           cotyledon._RESPAWN_BACKOFF_MIN * 2 ** i)
+            self.assertTrue(expected / 2.0 <= delay <= expected)
+        self.assertEqual(11, slot.failures)
+
+    def test_crash_backoff_reset_when_stable(self):
+        slot = cotyledon._WorkerSlot()
+        slot.started_at = 0
+        slot.next_respawn_delay(1, self.EXIT_1)
+        slot.next_respawn_delay(1, self.EXIT_1)
+        self.assertEqual(2, slot.failures)
+        self.assertEqual(0, slot.next_respawn_delay(
+            cotyledon._RESPAWN_STABLE_UPTIME, self.EXIT_1))
+        self.assertEqual(1, slot.failures)
+
+
+class TestAutoscalePolicy(base.TestCase):
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, cotyledon.AutoscalePolicy, 0, 2)
+        self.assertRaises(ValueError, cotyledon.AutoscalePolicy, 3, 2)
+        self.assertRaises(ValueError, cotyledon.AutoscalePolicy, 1, 2,
+                          metric='memory')
+        self.assertRaises(ValueError, cotyledon.AutoscalePolicy, 1, 2,
+                          scale_up=0.5, scale_down=0.5)
+
+    def test_get_workers(self):
+        policy = cotyledon.AutoscalePolicy(2, 4)
+        self.assertEqual(3, policy.get_workers(3, None))
+        self.assertEqual(4, policy.get_workers(3, 0.9))
+        self.assertEqual(4, policy.get_workers(4, 0.9))
+        self.assertEqual(3, policy.get_workers(3, 0.5))
+        self.assertEqual(2, policy.get_workers(3, 0.1))
+        self.assertEqual(2, policy.get_workers(2, 0.1))
+
+    def test_get_workers_out_of_bounds(self):
+        policy = cotyledon.AutoscalePolicy(2, 4)
+        self.assertEqual(2, policy.get_workers(1, None))
+        self.assertEqual(4, policy.get_workers(10, 0.5))
+
+
+class TestServiceManager(base.TestCase):
+    def test_invalid_start_concurrency(self):
+        for concurrency in (0, -1, 1.5, True):
+            self.assertRaises(ValueError, cotyledon.ServiceManager,
+                              start_concurrency=concurrency)
+
+    def test_invalid_ready_ratio(self):
+        for ratio in (0, -0.5, 1.5):
+            self.assertRaises(ValueError, cotyledon.ServiceManager,
+                              ready_ratio=ratio)
+        self.assertFalse(
+            cotyledon.ServiceManager._process_runner_already_created)
+
+
+class TestBindSocket(base.TestCase):
+    def test_bind_tcp(self):
+        sock = cotyledon._bind_socket(("127.0.0.1", 0))
+        self.addCleanup(sock.close)
+        self.assertEqual("127.0.0.1", sock.getsockname()[0])
+        self.assertNotEqual(0, sock.getsockname()[1])
+
+    @testtools.skipIf(not hasattr(socket, 'SO_REUSEPORT'),
+                      "SO_REUSEPORT unsupported")
+    def test_bind_reuseport(self):
+        reserved = cotyledon._bind_socket(("127.0.0.1", 0), reuseport=True)
+        self.addCleanup(reserved.close)
+        sock = cotyledon._bind_socket(reserved.getsockname(), reuseport=True)
+        self.addCleanup(sock.close)
+        self.assertEqual(reserved.getsockname(), sock.getsockname())
+
+    def test_bind_unix_stale(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "sock")
+        cotyledon._bind_socket(path).close()
+        sock = cotyledon._bind_socket(path)
+        self.addCleanup(sock.close)
+        sock.listen(1)
+        self.assertRaises(socket.error, cotyledon._bind_socket, path)
+
+    def test_bind_reuseport_unix(self):
+        self.assertRaises(ValueError, cotyledon._bind_socket,
+                          "/tmp/cotyledon.sock", reuseport=True)
+
+
+class TestTaskQueue(base.TestCase):
+    def test_invalid_queue(self):
+        self.assertRaises(ValueError, cotyledon.TaskQueue, batch_size=0)
+        self.assertRaises(ValueError, cotyledon.TaskQueue, batch_size=4,
+                          max_inflight=2)
+
+    def test_full(self):
+        q = cotyledon.TaskQueue(maxsize=1)
+        q.put("a")
+        self.assertRaises(queue.Full, q.put, "b", block=False)
+        self.assertRaises(queue.Full, q.put, "b", timeout=0.01)
+
+    def test_dispatch_and_requeue(self):
+        q = cotyledon.TaskQueue(batch_size=2, max_retries=1)
+        for i in range(5):
+            q.put(i)
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        q._add_worker(42, w)
+        q._dispatch()
+        self.assertEqual(1, q.qsize())
+        self.assertEqual(4, q.inflight())
+        self.assertEqual([0, 1], cotyledon.TaskService._read_batch(r))
+        self.assertEqual([2, 3], cotyledon.TaskService._read_batch(r))
+        q._task_done(42, 2)
+        self.assertEqual(2, q.inflight())
+        q._remove_worker(42)
+        self.assertEqual(3, q.qsize())
+        self.assertEqual(0, q.inflight())
+        self.assertEqual([2, 3, 4], [pickle.loads(data) for data, attempts
+                                     in q._pending])
+
+
+class TestStats(base.TestCase):
+    def test_stats_board(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "stats")
+        board = _stats._StatsBoard(2, path)
+        board.assign(1, 42, 1, "foo")
+        stats = _stats.Stats(board.buffer, 1)
+        stats.incr("requests")
+        stats.incr("requests", 2)
+        stats.set("queue", 5)
+        self.assertEqual(3, stats.get("requests"))
+        self.assertEqual(0, stats.get("unknown"))
+        # NOTE: a restarted worker gets back its stats
+        self.assertEqual(3, _stats.Stats(board.buffer, 1).get("requests"))
+        self.assertEqual([dict(service="foo", worker_id=1, pid=42,
+                               stats=dict(requests=3, queue=5))],
+                         cotyledon.read_stats(path))
+
+    def test_heartbeat(self):
+        board = _stats._StatsBoard(1)
+        _stats.Stats(board.buffer, 0)._set_heartbeat(42)
+        self.assertEqual(42, board.get_heartbeat(0))
+        board.assign(0, 1, 0, "foo")
+        self.assertEqual(0, board.get_heartbeat(0))
+
+    def test_tasks(self):
+        board = _stats._StatsBoard(1)
+        stats = _stats.Stats(board.buffer, 0)
+        stats._add_tasks(3)
+        stats._add_tasks(2)
+        self.assertEqual(5, board.get_tasks(0))
+        board.assign(0, 1, 0, "foo")
+        self.assertEqual(0, board.get_tasks(0))
+
+    def test_too_many_stats(self):
+        stats = cotyledon._get_worker_stats(0)
+        for i in range(_stats.MAX_STATS):
+            stats.set(str(i), i)
+        self.assertRaises(ValueError, stats.set, "other", 0)
+
+    def test_service_stats_attribute(self):
+        class Service(cotyledon.Service):
+            def __init__(self, worker_id):
+                super(Service, self).__init__(worker_id)
+                # NOTE: Services may have their own stats attribute
+                self.stats = {}
+
+        service = Service(0)
+        service.heartbeat()
+        service.task_done()
+        service.worker_stats.incr("requests")
+        self.assertEqual({}, service.stats)
+        self.assertEqual(1, service.worker_stats.get("requests"))
+
+
+class TestRecycle(base.TestCase):
+    def test_get_rss(self):
+        self.assertGreater(cotyledon._get_rss(os.getpid()), 0)
+
+
+class TestWatchdog(base.TestCase):
+    def test_watchdog_interval(self):
+        self.useFixture(fixtures.EnvironmentVariable("WATCHDOG_USEC",
+                                                     "3000000"))
+        self.useFixture(fixtures.EnvironmentVariable("WATCHDOG_PID",
+                                                     str(os.getpid())))
+        self.assertEqual(1.5,
+                         cotyledon.ServiceManager._get_watchdog_interval())
+        self.assertNotIn("WATCHDOG_USEC", os.environ)
+        self.useFixture(fixtures.EnvironmentVariable("WATCHDOG_USEC",
+                                                     "3000000"))
+        self.useFixture(fixtures.EnvironmentVariable("WATCHDOG_PID", "1"))
+        self.assertIsNone(cotyledon.ServiceManager._get_watchdog_interval())
+
+
+class TestCpuAffinity(base.TestCase):
+    def test_parse_cpu_list(self):
+        self.assertEqual(set([0, 1, 2, 3, 8, 10, 11]),
+                         cotyledon._parse_cpu_list("0-3,8,10-11\n"))
+
+    def test_numa_nodes(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        for node, cpulist in (("node1", "2-3"), ("node0", "0-1")):
+            os.mkdir(os.path.join(path, node))
+            with open(os.path.join(path, node, "cpulist"), "w") as f:
+                f.write(cpulist)
+        os.mkdir(os.path.join(path, "power"))
+        self.useFixture(fixtures.MonkeyPatch(
+            "cotyledon._NUMA_NODES_PATH", path))
+        self.assertEqual([set([0, 1]), set([2, 3])],
+                         cotyledon._get_numa_nodes())
+
+    @testtools.skipIf(not hasattr(os, 'sched_setaffinity'),
+                      "sched_setaffinity unsupported")
+    def test_cpu_sets(self):
+        self.useFixture(fixtures.MonkeyPatch(
+            "os.sched_getaffinity", lambda pid: set([0, 1, 2])))
+        self.assertEqual([set([0]), set([1, 2])],
+                         cotyledon._get_cpu_sets([0, [1, 2]]))
+        self.assertEqual(3, len(cotyledon._get_cpu_sets('round-robin')))
+        self.assertRaises(ValueError, cotyledon._get_cpu_sets, 'foo')
+        self.assertRaises(ValueError, cotyledon._get_cpu_sets, [])
+        for cpus in ([3], [[0, 3]], [-1], [True], ["0"], [0.0], [[]]):
+            self.assertRaises(ValueError, cotyledon._get_cpu_sets, cpus)
+
+
+class FakeManager(object):
+    _services = {}
+
+    def __init__(self):
+        # fd -> (callback, events) of the registered fds
+        self.handlers = {}
+
+    def _register_fd(self, fd, callback, events=select.POLLIN):
+        self.handlers[fd] = (callback, events)
+
+    def _unregister_fd(self, fd):
+        del self.handlers[fd]
+
+    def _call_later(self, delay, callback):
+        return [delay, callback]
+
+    def _cancel_timer(self, timer):
+        timer[1] = None
+
+    def stats(self):
+        return {}
+
+
+class TestControlServer(base.TestCase):
+    def test_commands(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        server = _control._ControlServer(FakeManager(), path)
+        self.assertEqual({"result": []},
+                         server._handle(b'{"command": "status"}'))
+        self.assertIn("invalid request",
+                      server._handle(b'{"command": "foo"}')["error"])
+        self.assertIn("invalid request",
+                      server._handle(b'{"command": "status", "foo": 1}')[
+                          "error"])
+        self.assertEqual({"error": "unknown service foo"}, server._handle(
+            b'{"command": "scale", "service": "foo", "workers": 2}'))
+        self.assertRaises(RuntimeError, _control._ControlServer,
+                          FakeManager(), path)
+        server.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_slow_client(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        manager = FakeManager()
+        server = _control._ControlServer(manager, path)
+        self.addCleanup(server.close)
+        result = "x" * 10 * 1024 * 1024
+        server._command_status = lambda: result
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.connect(path)
+        client.sendall(b'{"command": "status"}\n')
+        server._accept()
+        fd, = [fd for fd in manager.handlers if fd != server._sock.fileno()]
+        # NOTE: Doesn't block while the client doesn't read
+        manager.handlers[fd][0]()
+        callback, events = manager.handlers[fd]
+        self.assertEqual(select.POLLOUT, events)
+        data = b''
+        while fd in manager.handlers:
+            data += client.recv(1024 * 1024)
+            callback()
+        while not data.endswith(b'\n'):
+            data += client.recv(1024 * 1024)
+        self.assertEqual({"result": result}, json.loads(data.decode()))
+
+    def test_ctl_no_response(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.listen(1)
+        stderr = StringIO()
+        self.useFixture(fixtures.MonkeyPatch("sys.stderr", stderr))
+
+        # NOTE: The connection is closed without response, like the server
+        # does on an oversized request or a timeout
+        def close_connection():
+            conn = server.accept()[0]
+            conn.recv(4096)
+            conn.close()
+
+        thread = threading.Thread(target=close_connection)
+        thread.start()
+        self.assertEqual(1, _control.main([path, "status"]))
+        thread.join()
+        self.assertEqual("cotyledon-ctl: invalid response from %s\n" % path,
+                         stderr.getvalue())
+
+
+class TestMetrics(base.TestCase):
+    def test_render(self):
+        families = [
+            ("foo_exits", "counter", "Exits", [
+                ({"service": 'a"b\\', "reason": "SIGKILL"}, 2)]),
+            ("foo_stat", "unknown", "Stats", [({}, 0.5)]),
+        ]
+        self.assertEqual(
+            b'# HELP foo_exits Exits\n'
+            b'# TYPE foo_exits counter\n'
+            b'foo_exits_total{reason="SIGKILL",service="a\\"b\\\\"} 2.0\n'
+            b'# HELP foo_stat Stats\n'
+            b'# TYPE foo_stat unknown\n'
+            b'foo_stat 0.5\n'
+            b'# EOF\n', _metrics._render(families))
+        self.assertEqual(
+            b'# HELP foo_exits_total Exits\n'
+            b'# TYPE foo_exits_total counter\n'
+            b'foo_exits_total{reason="SIGKILL",service="a\\"b\\\\"} 2.0\n'
+            b'# HELP foo_stat Stats\n'
+            b'# TYPE foo_stat untyped\n'
+            b'foo_stat 0.5\n', _metrics._render(families, openmetrics=False))
+
+    def test_http(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "metrics")
+        manager = FakeManager()
+        exporter = _metrics._MetricsExporter(manager, path)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.connect(path)
+        client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        exporter._server._accept()
+        for fd, (callback, events) in list(manager.handlers.items()):
+            if fd != exporter._server._sock.fileno():
+                callback()
+        self.assertTrue(client.recv(4096).startswith(b"HTTP/1.0 200 OK"))
+        response = exporter._handle(b"GET /metrics HTTP/1.1\r\n"
+                                    b"Accept: application/openmetrics-text"
+                                    b"\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"Content-Type: application/openmetrics-text",
+                      response)
+        self.assertTrue(response.endswith(b"# EOF\n"))
+        response = exporter._handle(b"HEAD / HTTP/1.1\r\n\r\n")
+        self.assertIn(b"Content-Type: text/plain; version=0.0.4", response)
+        self.assertTrue(response.endswith(b"\r\n\r\n"))
+        self.assertTrue(exporter._handle(b"GET /foo HTTP/1.1\r\n\r\n")
+                        .startswith(b"HTTP/1.0 404 "))
+        self.assertTrue(exporter._handle(b"POST / HTTP/1.1\r\n\r\n")
+                        .startswith(b"HTTP/1.0 405 "))
+        self.assertTrue(exporter._handle(b"\r\n\r\n")
+                        .startswith(b"HTTP/1.0 400 "))
+        exporter.close()
+        self.assertFalse(os.path.exists(path))
+
+
+class TestLifecycle(base.TestCase):
+    def _fork_manager(self, setup, **kwargs):
+        """Run a ServiceManager configured by setup(manager) in a child"""
+        pid = os.fork()
+        if pid == 0:
+            with cotyledon._exit_on_exception():
+                manager = cotyledon.ServiceManager(**kwargs)
+                setup(manager)
+                manager.run()
+        self.addCleanup(self._kill_manager, pid)
+        return pid
+
+    @staticmethod
+    def _kill_manager(pid):
+        try:
+            # NOTE: The master is the leader of the process group of the
+            # workers
+            os.killpg(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def _wait_for(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = predicate()
+            if result:
+                return result
+            time.sleep(0.01)
+        self.fail("Timeout waiting for the ServiceManager")
+
+    def _wait_exit(self, pid):
+        """Return the exit status of the manager, fail if it hangs"""
+        def exited():
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            return wpid and [status]
+        return os.WEXITSTATUS(self._wait_for(exited)[0])
+
+    def _get_services(self, path):
+        try:
+            return dict((service["service"], service) for service in
+                        _control.send_command(path, "status"))
+        except (EnvironmentError, RuntimeError, ValueError):
+            return {}
+
+    @staticmethod
+    def _get_context_switches(pid):
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("voluntary_ctxt_switches:"):
+                    return int(line.split()[1])
+
+    def test_idle_master_sleeps(self):
+        r, w, service = self._recorder()
+        pid = self._fork_manager(lambda manager: manager.add(service, 2))
+        os.close(w)
+        for i in range(4):
+            self._read_event(r)
+        time.sleep(0.1)
+        switches = self._get_context_switches(pid)
+        time.sleep(0.5)
+        # NOTE: Polling every wait_interval would wake it up 50 times
+        self.assertLess(self._get_context_switches(pid) - switches, 5)
+
+    def test_respawn_without_delay(self):
+        r, w, service = self._recorder()
+        pid = self._fork_manager(lambda manager: manager.add(service))
+        os.close(w)
+        worker = self._read_event(r)[1]
+        self._read_event(r)
+        killed_at = time.time()
+        os.kill(worker, signal.SIGKILL)
+        kind, new_worker, worker_id = self._read_event(r)
+        self.assertEqual((b"i", 0), (kind, worker_id))
+        self.assertNotEqual(worker, new_worker)
+        self.assertLess(time.time() - killed_at, 1)
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    @staticmethod
+    def _get_pidfds(pid):
+        fds = []
+        for fd in os.listdir("/proc/%d/fd" % pid):
+            try:
+                target = os.readlink("/proc/%d/fd/%s" % (pid, fd))
+            except OSError:
+                continue
+            if target == "anon_inode:[pidfd]":
+                fds.append(fd)
+        return fds
+
+    @staticmethod
+    def _get_caught_signals(pid):
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("SigCgt:"):
+                    return int(line.split()[1], 16)
+
+    @testtools.skipUnless(cotyledon.ServiceManager._pidfd_supported(),
+                          "pidfd not supported")
+    def test_pidfd_per_worker(self):
+        r, w, service = self._recorder()
+        pid = self._fork_manager(lambda manager: manager.add(service, 3))
+        os.close(w)
+        workers = [p for kind, p, worker_id in
+                   [self._read_event(r) for i in range(6)] if kind == b"r"]
+        self.assertEqual(3, len(self._get_pidfds(pid)))
+        os.kill(workers[0], signal.SIGKILL)
+        self.assertEqual(b"i", self._read_event(r)[0])
+        self.assertEqual(b"r", self._read_event(r)[0])
+        # NOTE: The pidfd of the dead worker has been closed
+        self._wait_for(lambda: len(self._get_pidfds(pid)) == 3)
+        # NOTE: Children are not reaped on SIGCHLD
+        self.assertFalse(self._get_caught_signals(pid) &
+                         (1 << (signal.SIGCHLD - 1)))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    def test_reap_many_children_at_once(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        pid = self._fork_manager(
+            lambda manager: manager.add(cotyledon.Service, 20),
+            control_socket=path)
+
+        def running(excluded_pids=frozenset()):
+            workers = self._get_services(path).get("Service", {}).get(
+                "running", [])
+            pids = set(worker["pid"] for worker in workers)
+            return len(workers) == 20 and not pids & excluded_pids and workers
+
+        old_pids = set(worker["pid"] for worker in self._wait_for(running))
+        for worker_pid in old_pids:
+            os.kill(worker_pid, signal.SIGKILL)
+
+        workers = self._wait_for(lambda: running(old_pids))
+        self.assertEqual(list(range(20)),
+                         [worker["worker_id"] for worker in workers])
+        self.assertEqual([1] * 20, [worker["restarts"] for worker in workers])
+        for worker_pid in old_pids:
+            self.assertFalse(os.path.exists("/proc/%d" % worker_pid))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    def test_shutdown_groups(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+
+            class Service(cotyledon.Service):
+                def run(self):
+                    os.write(w, b"r")
+
+                def terminate(self):
+                    os.write(w, self.name.encode())
+
+            class Stuck(cotyledon.Service):
+                def __init__(self, worker_id):
+                    super(Stuck, self).__init__(worker_id)
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                    os.write(w, b"r")
+
+            with cotyledon._exit_on_exception():
+                manager = cotyledon.ServiceManager()
+                for name, group in (("b", 1), ("a", 0)):
+                    manager.add(type(name, (Service,), {"name": name}), 2,
+                                shutdown_group=group)
+                manager.add(Stuck, 1, shutdown_timeout=0.1)
+                manager.run()
+        os.close(w)
+        self.addCleanup(os.close, r)
+        self.assertEqual(b"rrrrr", cotyledon._read_exactly(r, 5))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertEqual(b"aabb", os.read(r, 10))
+
+    def test_shutdown_child_exited_in_later_group(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+
+            class Slow(cotyledon.Service):
+                def run(self):
+                    os.write(w, cotyledon._WORKER_ID.pack(0))
+
+                def terminate(self):
+                    time.sleep(1)
+
+            class Victim(cotyledon.Service):
+                def run(self):
+                    os.write(w, cotyledon._WORKER_ID.pack(os.getpid()))
+
+            with cotyledon._exit_on_exception():
+                manager = cotyledon.ServiceManager()
+                manager.add(Slow, shutdown_group=0)
+                manager.add(Victim, shutdown_group=1)
+                manager.run()
+        os.close(w)
+        self.addCleanup(os.close, r)
+        pids = [cotyledon._WORKER_ID.unpack(
+            cotyledon._read_exactly(r, 4))[0] for i in range(2)]
+        os.kill(pid, signal.SIGTERM)
+        time.sleep(0.2)
+        os.kill(max(pids), signal.SIGKILL)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid:
+                break
+            time.sleep(0.05)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.fail("the master is stuck")
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    def test_crash_loop_recovery(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        path = os.path.join(tmpdir, "control")
+        starts = os.path.join(tmpdir, "starts")
+
+        class Flapping(cotyledon.Service):
+            def run(self):
+                with open(starts, "a") as f:
+                    f.write("s")
+                if os.path.getsize(starts) <= 3:
+                    os._exit(1)
+
+        def setup(manager):
+            cotyledon._RESPAWN_BACKOFF_MIN = 0.01
+            cotyledon._RESPAWN_STABLE_UPTIME = 0.5
+            cotyledon._RESPAWN_CRASH_LOOP = 2
+            manager.add(Flapping)
+
+        self._fork_manager(setup, control_socket=path)
+        self._wait_for(lambda: os.path.exists(starts) and
+                       os.path.getsize(starts) == 4)
+        self.assertTrue(self._get_services(path)["Flapping"]["degraded"])
+        self._wait_for(lambda: not self._get_services(path)["Flapping"][
+            "degraded"])
+
+    def test_out_of_file_descriptors(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.Service):
+            def run(self):
+                os.write(w, b"r")
+
+        def setup(manager):
+            manager.add(Service, 80)
+            # NOTE: Not enough for a pidfd per worker
+            resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        self.assertEqual(b"r" * 80, cotyledon._read_exactly(r, 80))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    def test_zygote_reaps_orphans(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Daemonizing(cotyledon.Service):
+            def run(self):
+                pid = os.fork()
+                if pid == 0:
+                    os.setsid()
+                    if os.fork() == 0:
+                        os.write(w, cotyledon._WORKER_ID.pack(os.getpid()))
+                        time.sleep(0.1)
+                    os._exit(0)
+                os.waitpid(pid, 0)
+
+        pid = self._fork_manager(
+            lambda manager: manager.add(Daemonizing, zygote=True))
+        os.close(w)
+        orphan = cotyledon._WORKER_ID.unpack(
+            cotyledon._read_exactly(r, 4))[0]
+        # NOTE: A zombie keeps its /proc entry until it's reaped
+        self._wait_for(lambda: not os.path.exists("/proc/%d" % orphan))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    def test_zygote_fallback_preloads_master(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        preloaded = []
+
+        class Service(cotyledon.Service):
+            def run(self):
+                os.write(w, b"p" if preloaded else b"n")
+
+        def setup(manager):
+            # NOTE: The master can't reap the zygote's orphans
+            cotyledon._prctl = lambda *args: False
+            manager.add(Service, zygote=True,
+                        preload=lambda: preloaded.append(os.getpid()))
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        self.assertEqual(b"p", cotyledon._read_exactly(r, 1))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    def test_unix_listen_unlinked(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "sock")
+        for i in range(2):
+            pid = self._fork_manager(
+                lambda manager: manager.add(cotyledon.Service, listen=[path]))
+            self._wait_for(lambda: os.path.exists(path))
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, os.WEXITSTATUS(status))
+            self.assertFalse(os.path.exists(path))
+
+    def test_listen_sockets(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "sock")
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.Service):
+            def __init__(self, worker_id):
+                super(Service, self).__init__(worker_id)
+                # NOTE: Services may have their own sockets attribute
+                self.sockets = None
+
+            def run(self):
+                os.write(w, b"y" if self.listen_sockets[0].getsockname() ==
+                         path else b"n")
+
+        pid = self._fork_manager(
+            lambda manager: manager.add(Service, listen=[path]))
+        os.close(w)
+        self.assertEqual(b"y", cotyledon._read_exactly(r, 1))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    def test_scale_invalid_workers(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        self._fork_manager(lambda manager: manager.add(cotyledon.Service),
+                           control_socket=path)
+        self._wait_for(lambda: self._get_services(path))
+        for workers in (2.5, "2", True, 0):
+            self.assertRaises(RuntimeError, _control.send_command, path,
+                              "scale", service="Service", workers=workers)
+        self.assertEqual(1, self._get_services(path)["Service"]["workers"])
+
+    def test_restart_invalid_worker(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        self._fork_manager(lambda manager: manager.add(cotyledon.Service),
+                           control_socket=path)
+        self._wait_for(lambda: self._get_services(path))
+        for worker_id in (1, -1, 0.0, "0", True):
+            self.assertRaises(RuntimeError, _control.send_command, path,
+                              "restart", service="Service",
+                              worker_id=worker_id)
+        _control.send_command(path, "restart", service="Service",
+                              worker_id=0)
+
+    def test_scale_above_max_workers(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        self._fork_manager(
+            lambda manager: manager.add(cotyledon.Service, max_workers=2),
+            control_socket=path)
+        self._wait_for(lambda: self._get_services(path))
+        _control.send_command(path, "scale", service="Service", workers=2)
+        self.assertRaises(RuntimeError, _control.send_command, path,
+                          "scale", service="Service", workers=3)
+        self.assertEqual(2, self._get_services(path)["Service"]["workers"])
+
+    def test_scale_autoscaled(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "control")
+        policy = cotyledon.AutoscalePolicy(1, 3, interval=0.05, cooldown=60)
+        self._fork_manager(
+            lambda manager: manager.add(cotyledon.Service, autoscale=policy),
+            control_socket=path)
+        self._wait_for(lambda: self._get_services(path))
+        self.assertRaises(RuntimeError, _control.send_command, path,
+                          "scale", service="Service", workers=4)
+        _control.send_command(path, "scale", service="Service", workers=3)
+        # NOTE: Idle workers, but the policy waits for its cooldown
+        time.sleep(0.3)
+        self.assertEqual(3, self._get_services(path)["Service"]["workers"])
+
+    def test_terminate_waits_for_run(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.Service):
+            def __init__(self, worker_id):
+                super(Service, self).__init__(worker_id)
+                self._stop = threading.Event()
+                self._done = threading.Event()
+
+            def run(self):
+                os.write(w, b"r")
+                self._stop.wait()
+                self._done.set()
+
+            def terminate(self):
+                self._stop.set()
+                self._done.wait()
+                os.write(w, b"t")
+
+        pid = self._fork_manager(lambda manager: manager.add(Service))
+        os.close(w)
+        self.assertEqual(b"r", cotyledon._read_exactly(r, 1))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+        self.assertEqual(b"t", os.read(r, 1))
+
+    @testtools.skipIf(sys.version_info < (3, 4), "requires main_thread()")
+    def test_run_in_main_thread(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.Service):
+            def run(self):
+                os.write(w, str(int(threading.current_thread() is
+                                    threading.main_thread())).encode())
+
+        def setup(manager):
+            manager.add(Service)
+            manager.add(type("Main", (Service,),
+                             {"run_in_main_thread": True}))
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        self.assertEqual([b"0", b"1"], sorted(
+            [cotyledon._read_exactly(r, 1) for i in range(2)]))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    _EVENT = struct.Struct("!cii")
+
+    class _Recorder(cotyledon.Service):
+        """Write (b"i", pid, worker_id) on init and b"r" on run to fd"""
+        fd = None
+
+        def __init__(self, worker_id):
+            super(TestLifecycle._Recorder, self).__init__(worker_id)
+            os.write(self.fd, TestLifecycle._EVENT.pack(b"i", self.pid,
+                                                        worker_id))
+
+        def run(self):
+            os.write(self.fd, TestLifecycle._EVENT.pack(b"r", self.pid,
+                                                        self.worker_id))
+
+    def _read_event(self, r, timeout=10):
+        if not select.select([r], [], [], timeout)[0]:
+            self.fail("Timeout waiting for the ServiceManager")
+        return self._EVENT.unpack(cotyledon._read_exactly(r,
+                                                          self._EVENT.size))
+
+    def _recorder(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        return r, w, type("Recorder", (self._Recorder,), {"fd": w})
+
+    def test_reconfigure_from_thread(self):
+        r, w, service = self._recorder()
+
+        def setup(manager):
+            service_id = manager.add(service, max_workers=3)
+
+            def scale():
+                time.sleep(0.2)
+                manager.reconfigure(service_id, 3)
+
+            threading.Thread(target=scale).start()
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        events = [self._read_event(r) for i in range(6)]
+        self.assertEqual([0, 1, 2], sorted(worker_id for kind, p, worker_id
+                                           in events if kind == b"r"))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    def _reloading_recorder(self, trigger):
+        """Recorder writing b"h" on reload, ready once trigger exists"""
+        r, w, service = self._recorder()
+
+        def reload(self):
+            os.write(self.fd, TestLifecycle._EVENT.pack(b"h", self.pid,
+                                                        self.worker_id))
+            while not os.path.exists(trigger):
+                time.sleep(0.01)
+
+        return r, w, type("Reloading", (service,), {"reload": reload})
+
+    def test_rolling_reload(self):
+        trigger = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                               "trigger")
+        r, w, service = self._reloading_recorder(trigger)
+        pid = self._fork_manager(lambda manager: manager.add(
+            service, 4, reload_batch=2))
+        os.close(w)
+        for i in range(8):
+            self._read_event(r)
+        os.kill(pid, signal.SIGHUP)
+        self.assertEqual([0, 1], sorted(self._read_event(r)[2]
+                                        for i in range(2)))
+        # NOTE: The next batch waits for the first one to be ready
+        self.assertFalse(select.select([r], [], [], 0.5)[0])
+        open(trigger, "w").close()
+        self.assertEqual([2, 3], sorted(self._read_event(r)[2]
+                                        for i in range(2)))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    @testtools.skipIf(sys.version_info < (3, 5), "AsyncService requires 3.5")
+    def test_rolling_reload_async(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.AsyncService):
+            def __init__(self, worker_id):
+                super(Service, self).__init__(worker_id)
+                time.sleep(0.5)
+
+        def ready(service_id, worker_id, pid, init_duration):
+            os.write(w, TestLifecycle._EVENT.pack(b"y", pid, worker_id))
+
+        pid = self._fork_manager(lambda manager: (
+            manager.add(Service, 2, reload_batch=1),
+            manager.register_hooks(on_worker_ready=ready)))
+        os.close(w)
+        # NOTE: Once the master got the readiness of the workers
+        for i in range(2):
+            self._read_event(r)
+        os.kill(pid, signal.SIGHUP)
+        self.assertEqual(0, self._read_event(r)[2])
+        replaced_at = time.time()
+        # NOTE: The exiting worker doesn't report itself ready, so worker 1
+        # is only reloaded once the replacement of worker 0 is ready
+        self.assertEqual(1, self._read_event(r)[2])
+        self.assertGreater(time.time() - replaced_at, 0.4)
+
+    def test_rolling_reload_timeout(self):
+        trigger = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                               "trigger")
+        r, w, service = self._reloading_recorder(trigger)
+
+        def setup(manager):
+            cotyledon._ROLLING_RELOAD_TIMEOUT = 0.2
+            manager.add(service, 2, reload_batch=1)
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        for i in range(4):
+            self._read_event(r)
+        os.kill(pid, signal.SIGHUP)
+        # NOTE: Worker 0 never gets ready, worker 1 is reloaded anyway
+        self.assertEqual(0, self._read_event(r)[2])
+        self.assertEqual(1, self._read_event(r)[2])
+
+    def test_recycle_max_age(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        def ready(service_id, worker_id, pid, init_duration):
+            os.write(w, self._EVENT.pack(b"y", pid, worker_id))
+
+        def exited(service_id, worker_id, pid, status, runtime):
+            os.write(w, self._EVENT.pack(b"e", pid, worker_id))
+
+        def setup(manager):
+            cotyledon._RECYCLE_INTERVAL = 0.05
+            manager.add(cotyledon.Service, 2, max_age=0.5)
+            manager.register_hooks(on_worker_ready=ready,
+                                   on_worker_exit=exited)
+
+        self._fork_manager(setup)
+        os.close(w)
+        workers = {}
+        for i in range(2):
+            event, pid, worker_id = self._read_event(r)
+            self.assertEqual(b"y", event)
+            workers[worker_id] = pid
+        for i in range(4):
+            # NOTE: The next worker is recycled once the replacement of
+            # the previous one is ready
+            event, pid, worker_id = self._read_event(r)
+            self.assertEqual((b"e", workers[worker_id]),
+                             (event, pid))
+            event, pid, replaced = self._read_event(r)
+            self.assertEqual((b"y", worker_id), (event, replaced))
+            self.assertNotEqual(workers[worker_id], pid)
+            workers[worker_id] = pid
+
+    def test_missed_heartbeat(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        class Service(cotyledon.Service):
+            def run(self):
+                for i in range(5):
+                    self.heartbeat()
+                    time.sleep(0.05)
+                while self.worker_id == 0:
+                    self.heartbeat()
+                    time.sleep(0.05)
+                # NOTE: Worker 1 is stuck from now on
+                time.sleep(60)
+
+        def ready(service_id, worker_id, pid, init_duration):
+            os.write(w, self._EVENT.pack(b"y", pid, worker_id))
+
+        def exited(service_id, worker_id, pid, status, runtime):
+            killed = (os.WIFSIGNALED(status) and
+                      os.WTERMSIG(status) == signal.SIGKILL)
+            os.write(w, self._EVENT.pack(b"k" if killed else b"e", pid,
+                                         worker_id))
+
+        self._fork_manager(lambda manager: (
+            manager.add(Service, 2, heartbeat_timeout=0.5),
+            manager.register_hooks(on_worker_ready=ready,
+                                   on_worker_exit=exited)))
+        os.close(w)
+        workers = {}
+        for i in range(2):
+            event, pid, worker_id = self._read_event(r)
+            self.assertEqual(b"y", event)
+            workers[worker_id] = pid
+        self.assertEqual((b"k", workers[1], 1), self._read_event(r))
+        event, pid, worker_id = self._read_event(r)
+        self.assertEqual((b"y", 1), (event, worker_id))
+        self.assertNotEqual(workers[1], pid)
+
+    def _notify_socket(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            "notify")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(path)
+        self.useFixture(fixtures.EnvironmentVariable("NOTIFY_SOCKET", path))
+        return sock
+
+    def _ready_notified(self, sock, timeout):
+        while select.select([sock], [], [], timeout)[0]:
+            if sock.recv(64) == b"READY=1":
+                return True
+        return False
+
+    def test_notify_ready_when_all_workers_ready(self):
+        sock = self._notify_socket()
+        trigger = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                               "trigger")
+
+        class Service(cotyledon.Service):
+            ready_on_init = False
+
+            def run(self):
+                while self.worker_id and not os.path.exists(trigger):
+                    time.sleep(0.01)
+                self.notify_ready()
+
+        self._fork_manager(lambda manager: manager.add(Service, 2))
+        self.assertFalse(self._ready_notified(sock, 0.5))
+        open(trigger, "w").close()
+        self.assertTrue(self._ready_notified(sock, 10))
+
+    def test_notify_ready_ratio(self):
+        sock = self._notify_socket()
+
+        class Service(cotyledon.Service):
+            ready_on_init = False
+
+            def run(self):
+                if self.worker_id < 2:
+                    self.notify_ready()
+
+        self._fork_manager(lambda manager: manager.add(Service, 4),
+                           ready_ratio=0.5)
+        self.assertTrue(self._ready_notified(sock, 10))
+
+    def test_spare_promotion(self):
+        r, w, service = self._recorder()
+        pid = self._fork_manager(lambda manager: manager.add(service,
+                                                             spares=1))
+        os.close(w)
+        events = [self._read_event(r) for i in range(3)]
+        worker = [p for kind, p, worker_id in events if kind == b"r"][0]
+        spare = [p for kind, p, worker_id in events
+                 if worker_id == cotyledon._SPARE_WORKER_ID][0]
+        # NOTE: Let the spare report to the master that it's parked
+        time.sleep(0.2)
+        os.kill(worker, signal.SIGKILL)
+        # NOTE: The spare runs as worker 0 and a new spare is forked
+        events = sorted(self._read_event(r) for i in range(2))
+        self.assertEqual((b"r", spare, 0), events[1])
+        self.assertEqual((b"i", cotyledon._SPARE_WORKER_ID),
+                         (events[0][0], events[0][2]))
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    def test_spare_promotion_timeout(self):
+        r, w, service = self._recorder()
+
+        def setup(manager):
+            cotyledon._SPARE_PROMOTION_TIMEOUT = 0.1
+            wait_promotion = manager._wait_promotion
+
+            def slow_wait_promotion(config):
+                select.select([config.spare_read_fd], [], [])
+                time.sleep(0.5)
+                wait_promotion(config)
+
+            manager._wait_promotion = slow_wait_promotion
+            manager.add(service, spares=1)
+
+        pid = self._fork_manager(setup)
+        os.close(w)
+        events = [self._read_event(r) for i in range(3)]
+        worker = [p for kind, p, worker_id in events if kind == b"r"][0]
+        spare = [p for kind, p, worker_id in events
+                 if worker_id == cotyledon._SPARE_WORKER_ID][0]
+        # NOTE: Let the spare report to the master that it's parked
+        time.sleep(0.2)
+        os.kill(worker, signal.SIGKILL)
+        # NOTE: Worker 0 is forked once the promotion times out
+        kind, new_worker, worker_id = self._read_event(r)
+        self.assertEqual(b"i", kind)
+        self.assertEqual(0, worker_id)
+        self.assertEqual((b"r", new_worker, 0), self._read_event(r))
+        # NOTE: The spare promoted too late is stopped and replaced
+        self._wait_for(lambda: not os.path.exists("/proc/%d" % spare))
+        kind, new_spare, worker_id = self._read_event(r)
+        while kind == b"r" and new_spare == spare:
+            kind, new_spare, worker_id = self._read_event(r)
+        self.assertEqual((b"i", cotyledon._SPARE_WORKER_ID),
+                         (kind, worker_id))
+        os.kill(new_worker, 0)
+        os.kill(pid, signal.SIGTERM)
+        self.assertEqual(0, self._wait_exit(pid))
+
+    def test_spare_crash_backoff(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        starts = os.path.join(tmpdir, "starts")
+
+        class Failing(cotyledon.Service):
+            def __init__(self, worker_id):
+                super(Failing, self).__init__(worker_id)
+                if worker_id == cotyledon._SPARE_WORKER_ID:
+                    with open(starts, "a") as f:
+                        f.write("s")
+                    os._exit(1)
+
+        def setup(manager):
+            cotyledon._RESPAWN_BACKOFF_MIN = 0.1
+            manager.add(Failing, spares=1)
+
+        self._fork_manager(setup)
+        self._wait_for(lambda: os.path.exists(starts))
+        time.sleep(1)
+        # NOTE: 0, 0, 0.1, 0.2, 0.4 seconds of backoff, with jitter
+        self.assertLess(os.path.getsize(starts), 10)
+
+    @testtools.skipIf(sys.version_info < (3, 7), "requires gc.freeze()")
+    def test_gc_frozen_only_after_preload(self):
+        import gc
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        def write_freeze_count(*args):
+            os.write(w, struct.pack("!i", gc.get_freeze_count()))
+
+        for preload in (None, lambda: None):
+            pid = self._fork_manager(lambda manager: (
+                manager.add(cotyledon.Service),
+                manager.register_hooks(on_preload=preload,
+                                       on_worker_ready=write_freeze_count)))
+            count = struct.unpack("!i", cotyledon._read_exactly(r, 4))[0]
+            if preload is None:
+                self.assertEqual(0, count)
+            else:
+                self.assertGreater(count, 0)
+            os.kill(pid, signal.SIGTERM)
+            self.assertEqual(0, self._wait_exit(pid))
+        os.close(w)
+
+    def test_hooks(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+
+            def hook(event):
+                def write(*args):
+                    os.write(w, event)
+                return write
+
+            with cotyledon._exit_on_exception():
+                manager = cotyledon.ServiceManager()
+                manager.add(cotyledon.Service)
+                manager.register_hooks(on_fork=hook(b"f"),
+                                       on_worker_ready=hook(b"r"),
+                                       on_worker_exit=hook(b"e"),
+                                       on_shutdown=hook(b"s"))
+                manager.register_hooks(on_shutdown=lambda: 1 / 0)
+                manager.run()
+        os.close(w)
+        self.addCleanup(os.close, r)
+        self.assertEqual(b"fr", cotyledon._read_exactly(r, 2))
+        os.kill(pid, signal.SIGTERM)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertEqual(b"se", cotyledon._read_exactly(r, 2))
+
+
+@testtools.skipIf(sys.version_info < (3, 5), "AsyncService requires 3.5")
+class TestAsyncService(base.TestCase):
+    def _run_service(self, **attrs):
+        """Run an AsyncService, return its pid and the read end of w"""
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            import asyncio
+
+            async def run(self):
+                os.write(w, b"r")
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    os.write(w, b"c")
+                    if attrs.get("ignore_cancel"):
+                        await asyncio.sleep(60)
+                    raise
+
+            with cotyledon._exit_on_exception():
+                attrs.setdefault("run", run)
+                type("Service", (cotyledon.AsyncService,), attrs)(0)._run()
+        os.close(w)
+        self.addCleanup(os.close, r)
+        self.addCleanup(self._kill, pid)
+        self.assertEqual(b"r", os.read(r, 1))
+        return pid, r
+
+    @staticmethod
+    def _kill(pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def _terminate(self, pid, timeout=10):
+        os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            wpid, status = os.waitpid(pid, os.WNOHANG)
+            if wpid:
+                return os.WEXITSTATUS(status)
+            time.sleep(0.01)
+        self.fail("The service is stuck")
+
+    def test_graceful_exit(self):
+        def terminate(self):
+            raise SystemExit(3)
+
+        pid, r = self._run_service(terminate=terminate)
+        self.assertEqual(3, self._terminate(pid))
+        self.assertEqual(b"c", os.read(r, 1))
+
+    def test_terminate_coroutine(self):
+        import asyncio
+
+        async def terminate(self):
+            await asyncio.sleep(0.01)
+            raise SystemExit(4)
+
+        pid, r = self._run_service(terminate=terminate)
+        self.assertEqual(4, self._terminate(pid))
+        self.assertEqual(b"c", os.read(r, 1))
+
+    def test_reload_before_event_loop(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+
+        def __init__(self, worker_id):
+            cotyledon.AsyncService.__init__(self, worker_id)
+            # NOTE: SIGHUP caught by the handler of the ServiceManager
+            self._reload(signal.SIGHUP, None)
+
+        async def reload(self):
+            os.write(w, b"h")
+
+        self._run_service(__init__=__init__, reload=reload)
+        os.close(w)
+        self.assertEqual([r], select.select([r], [], [], 10)[0])
+        self.assertEqual(b"h", os.read(r, 1))
+
+    def test_terminate_exception(self):
+        async def terminate(self):
+            raise ValueError("boom")
+
+        pid, r = self._run_service(terminate=terminate)
+        self.assertEqual(2, self._terminate(pid))
+        self.assertEqual(b"c", os.read(r, 1))
+
+    def test_terminate_timeout(self):
+        import asyncio
+
+        async def terminate(self):
+            await asyncio.sleep(60)
+
+        pid, r = self._run_service(terminate=terminate,
+                                   graceful_shutdown_timeout=0.1)
+        self.assertEqual(0, self._terminate(pid, timeout=5))
+        self.assertEqual(b"c", os.read(r, 1))
+
+    def test_cancel_timeout(self):
+        pid, r = self._run_service(ignore_cancel=True,
+                                   graceful_shutdown_timeout=0.1)
+        self.assertEqual(0, self._terminate(pid, timeout=5))
+        self.assertEqual(b"c", os.read(r, 1))